@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+import argparse
+import collections
+import json
+import os
+import struct
+import sys
+import time
+
+import numpy as np
+
+# The results are printed on stdout, keep it clean.
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+import display_map
+
+# Game cycles are 1/20th of a second.
+TICK_MS = 50
+ZOOMS = [2.0, 1.0, 0.5, 0.25]
+LAYERS = [(0, 6), (2, 6), (4, 6), (0, 6), (3, 6)]
+# Game cycles simulated per number of pedestrians or cars.
+AGENT_TICKS = 200
+
+def find_file(directory, name):
+    """ Case insensitive lookup, the game files are not consistent (e.g. Style001.g24 vs STYLE001.G24). """
+    for f in os.listdir(directory):
+        if f.upper() == name.upper():
+            return os.path.join(directory, f)
+    return None
+
+def find_cities(paths, ext):
+    """ Returns (cmp, style) pairs for all the CMP files in paths (files or directories). """
+    cities = []
+    for path in paths:
+        if os.path.isdir(path):
+            cmp_files = sorted(os.path.join(path, f) for f in os.listdir(path) if f.upper().endswith('.CMP'))
+        else:
+            cmp_files = [path]
+        for cmp_file in cmp_files:
+            with open(cmp_file, 'rb') as f:
+                style_number = struct.unpack('<I B', f.read(5))[1]
+            style_file = find_file(os.path.dirname(cmp_file) or '.', f"STYLE{style_number:03}.{ext}")
+            if style_file is None:
+                print(f"WARNING: No STYLE{style_number:03}.{ext} for {cmp_file}, skipping it", file=sys.stderr)
+                continue
+            cities.append((cmp_file, style_file))
+    return cities
+
+def dense_districts(cmp, count=4, size=16):
+    """ Returns the centers of the count districts of size x size blocks with the most blocks. """
+    density = np.zeros((256, 256), dtype=np.int32)
+    for y in range(256):
+        for x in range(256):
+            height, _ = cmp.get_column(x, y)
+            density[y, x] = 6 - height
+    districts = density.reshape(256 // size, size, 256 // size, size).sum(axis=(1, 3))
+    # Sort by decreasing density, then by position so that the path is always the same.
+    order = sorted(np.ndindex(districts.shape), key=lambda d: (-districts[d], d))
+    return [((dx + 0.5) * size, (dy + 0.5) * size) for dy, dx in order[:count]]
+
+def camera_path(cmp, frames):
+    """ Returns, for each frame, the view to render: (x, y, zoom, layers, apply_remaps).
+
+    The camera flies in a loop between the densest districts, going through all the
+    zoom levels and a few sets of layers, and toggling remaps from time to time.
+    """
+    waypoints = dense_districts(cmp)
+    path = []
+    for i in range(frames):
+        t = i * len(waypoints) / frames
+        k = int(t)
+        f = t - k
+        (x1, y1), (x2, y2) = waypoints[k], waypoints[(k + 1) % len(waypoints)]
+        zoom = ZOOMS[i * 2 * len(ZOOMS) // frames % len(ZOOMS)]
+        min_z, max_z = LAYERS[i * len(LAYERS) // frames]
+        apply_remaps = (i * 5 // frames) % 2 == 0
+        path.append((x1 + (x2 - x1) * f, y1 + (y2 - y1) * f, zoom, range(min_z, max_z), apply_remaps))
+    return path
+
+def percentiles(values):
+    values = np.array(values)
+    return {
+        'mean': float(values.mean()), 'p50': float(np.percentile(values, 50)),
+        'p95': float(np.percentile(values, 95)), 'p99': float(np.percentile(values, 99)), 'max': float(values.max()),
+    }
+
+def benchmark_agents(create, sizes):
+    """ Times the game cycles of a simulation (e.g. Crowd) for the given numbers of agents,
+    and finds the largest one fitting in a cycle. create(count) returns the simulation.
+    """
+    tick_ms = {}
+    for count in sizes:
+        agents = create(count)
+        times = []
+        for _ in range(AGENT_TICKS):
+            start = time.perf_counter()
+            agents.step()
+            times.append(1000 * (time.perf_counter() - start))
+        tick_ms[str(count)] = percentiles(times)
+    in_budget = [count for count in sizes if tick_ms[str(count)]['p95'] < TICK_MS]
+    return {'tick_ms': tick_ms, 'max_in_budget': max(in_budget, default=0)}
+
+class RandomDriver:
+    """ Drives count Vehicles of the given models with random controls, changing every game cycle. """
+    def __init__(self, car_info, cars, count, seed=0):
+        self.rng = np.random.default_rng(seed)
+        self.vehicles = display_map.Vehicles(car_info, self.rng.choice(cars, count))
+
+    def step(self):
+        count = len(self.vehicles)
+        self.vehicles.throttle = self.rng.uniform(-1, 1, count)
+        self.vehicles.steer = self.rng.uniform(-1, 1, count)
+        self.vehicles.handbrake = self.rng.random(count) < 0.1
+        self.vehicles.step()
+
+def benchmark(cmp_file, style_file, frames, size, render_threads=1, crowd_sizes=(), traffic_sizes=(), vehicles_sizes=()):
+    start = time.perf_counter()
+    renderer = display_map.MapRenderer(cmp_file, style_file, width=size[0], height=size[1], headless=True, render_threads=render_threads)
+    load_s = time.perf_counter() - start
+    renderer.stats.history = collections.deque(maxlen=frames)
+    frame_ms = []
+    for i, (x, y, zoom, layers, apply_remaps) in enumerate(camera_path(renderer.cmp, frames)):
+        renderer.apply_remaps = apply_remaps
+        start = time.perf_counter()
+        renderer.render_view(x, y, zoom, layers=layers, size=size, ticks=i * TICK_MS)
+        frame_ms.append(1000 * (time.perf_counter() - start))
+        renderer.stats.end_frame()
+    history = list(renderer.stats.history)
+    return {
+        'cmp': cmp_file, 'style': style_file, 'frames': frames, 'resolution': f"{size[0]}x{size[1]}",
+        'render_threads': render_threads,
+        'load_s': load_s,
+        'frame_ms': percentiles(frame_ms),
+        'phases_ms': {phase: 1000 * float(np.mean([times[phase] for times, _ in history]))
+                      for phase in ['sides', 'lids', 'objects']},
+        'counters': {c: int(sum(counts[c] for _, counts in history)) for c in display_map.FrameStats.counters},
+        'cache': {'surfaces': len(renderer.surface_cache), 'sprites': len(renderer.sprite_cache)},
+        'crowd': benchmark_agents(lambda count: display_map.Crowd(renderer.world.surface_levels(display_map.PAVEMENT), count), crowd_sizes) if crowd_sizes else None,
+        'traffic': benchmark_agents(lambda count: display_map.Traffic(*renderer.world.road_lanes(), renderer.world.traffic_cars(), count), traffic_sizes) if traffic_sizes else None,
+        'vehicles': benchmark_agents(lambda count: RandomDriver(renderer.g24.car_info, renderer.world.traffic_cars(), count), vehicles_sizes) if vehicles_sizes else None,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the map rendering along a fixed camera path')
+    parser.add_argument('paths', nargs='+', help='CMP files or directories containing CMP files (e.g. gamedata/gta gamedata/gta-uk)')
+    parser.add_argument('--ext', default='G24', choices=['G24', 'GRY'], help='Style file type to use')
+    parser.add_argument('--frames', type=int, default=400, help='Number of frames to render per city')
+    parser.add_argument('--resolution', '-r', type=display_map.resolution, default='1024x768', help='Rendering resolution')
+    parser.add_argument('--render-threads', type=int, default=1, help='Number of threads rasterizing the sides of the blocks')
+    parser.add_argument('--crowd', type=int, nargs='+', default=[], help='Also time the game cycles of crowds of these numbers of pedestrians (e.g. 500 1000 2000 4000 8000)')
+    parser.add_argument('--traffic', type=int, nargs='+', default=[], help='Also time the game cycles of the traffic with these numbers of cars (e.g. 100 300 1000)')
+    parser.add_argument('--vehicles', type=int, nargs='+', default=[], help='Also time the game cycles of the dynamics of these numbers of cars (e.g. 100 1000 10000)')
+    parser.add_argument('--output', '-o', help='Write the results to this JSON file instead of stdout')
+    args = parser.parse_args()
+
+    cities = find_cities(args.paths, args.ext)
+    if not cities:
+        print("No city found", file=sys.stderr)
+        sys.exit(1)
+
+    results = []
+    for cmp_file, style_file in cities:
+        print(f"Benchmarking {cmp_file} with {style_file}", file=sys.stderr)
+        results.append(benchmark(cmp_file, style_file, args.frames, args.resolution, args.render_threads, args.crowd, args.traffic, args.vehicles))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
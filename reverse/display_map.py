@@ -1,28 +1,214 @@
+from __future__ import annotations
+import time
+START_TIME = time.perf_counter()
+
 import argparse
-import cv2
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import importlib
 import math
-import numpy as np
-import pygame
-from pygame import gfxdraw
 import struct
 import sys
 import os
+import queue
+import threading
+
+class LazyModule:
+    """ Stands for a module until it's first used, then imports it and replaces itself in this module.
+
+    cv2, numpy and pygame take a large part of the startup time, only import them when they are used.
+    """
+    def __init__(self, name, alias):
+        self.name, self.alias = name, alias
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.name)
+        globals()[self.alias] = module
+        return getattr(module, attr)
+
+cv2 = LazyModule('cv2', 'cv2')
+np = LazyModule('numpy', 'np')
+pygame = LazyModule('pygame', 'pygame')
+
+# Game cycles are 1/20th of a second, the simulation advances by one cycle at a time.
+SIM_TICK_MS = 50
+# Maximum number of cycles simulated per rendered frame when the rendering can't keep up.
+MAX_SIM_STEPS = 5
+# Size of the minimap in pixels.
+MINIMAP_SIZE = 192
+# Inputs of the player for a game cycle, as a bit mask (see World.step): controls held during the cycle...
+INPUT_UP, INPUT_DOWN, INPUT_LEFT, INPUT_RIGHT, INPUT_FIRE, INPUT_HANDBRAKE = (1 << bit for bit in range(6))
+INPUT_HELD = (1 << 8) - 1
+# ... and actions applied once: switch between car and pedestrian, next/previous car, next/previous weapon.
+INPUT_SWITCH, INPUT_NEXT_CAR, INPUT_PREVIOUS_CAR, INPUT_NEXT_WEAPON, INPUT_PREVIOUS_WEAPON = (1 << bit for bit in range(8, 13))
+# Keys of play mode for the bits of the inputs, in the same order.
+INPUT_KEYS = ['K_UP', 'K_DOWN', 'K_LEFT', 'K_RIGHT', 'K_LCTRL', 'K_SPACE']
+INPUT_ACTIONS_SHIFT = 8
+INPUT_ACTIONS = ['K_c', 'K_n', 'K_p', 'K_w', 'K_x']
+
+# States of the traffic lights, as offsets from the first traffic light sprite.
+LIGHT_RED, LIGHT_GREEN, LIGHT_AMBER, LIGHT_OFF = range(4)
+# State of a traffic light at each cycle: green - amber - red - blinking amber.
+# The lights of the other direction are half a cycle late, so they are red while these are not.
+TRAFFIC_LIGHT_CYCLE = [LIGHT_GREEN] * 100 + [LIGHT_AMBER] * 30 + [LIGHT_RED] * 160 + ([LIGHT_AMBER] * 5 + [LIGHT_OFF] * 5) * 3
+
+# Pedestrians of the crowd walk at the same speed as the player, in blocks per game cycle.
+CROWD_WALK_SPEED = 0.03
+# Pedestrians closer than this (in blocks) push each other away.
+CROWD_RADIUS = 0.25
+# Block types of the roads, where cars drive, and of the pavements, where pedestrians walk.
+ROAD, PAVEMENT = 2, 3
+# Block types that can't be walked or driven through, unless they are flat or sloped: road, pavement, field and building.
+SOLID_TYPES = [2, 3, 4, 5]
+# Half size of the box of a pedestrian for the collisions, in blocks.
+PEDESTRIAN_HALF_SIZE = 0.125
+
+# Cars of the traffic drive at about this speed, in blocks per game cycle.
+TRAFFIC_SPEED = 0.1
+# Moves in blocks for the direction bits of the blocks: up (north), down (south), left (west) and right (east).
+DIRECTIONS = [(0, -1), (0, 1), (-1, 0), (1, 0)]
+# Sprite rotation for each direction, 0 being south like for the player.
+DIRECTION_ROTATIONS = [180, 0, 270, 90]
+# Emergency services, named like their groups of CMPParser.locations.
+SERVICES = ['police', 'hospital', 'fire']
+
+# The float values of car_info are 16.16 fixed point numbers, see modify_gry.convert_float.
+FIXED_ONE = 65536
+# Fraction of the speed lost per game cycle by a car neither accelerating nor braking.
+CAR_DRAG = 0.1
+# Cars turn this many times faster (on a smaller circle) going backward, and with the handbrake.
+CAR_REVERSE_TURN = 2
+CAR_HANDBRAKE_TURN = 2
+
+class TileList:
+    """ A range of the tiles of a G24Parser, to be indexed like a list of (64, 64) arrays. """
+    def __init__(self, parser, first, count):
+        self.parser, self.first, self.count = parser, first, count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        if not 0 <= idx < self.count:
+            raise IndexError(idx)
+        return self.parser.get_tile(self.first + idx)
 
 class G24Parser:
     def __init__(self, filepath):
         with open(filepath, 'rb') as f:
             self.data = f.read()
+        self.parse()
+
+    # Sections parsed on first access to one of their attributes (see __getattr__).
+    lazy_attributes = {
+        'object_info': 'object_info', 'car_info': 'car_info', 'sprite_info': 'sprite_info',
+        'sprite_graphics': 'sprite_graphics', 'sprite_bases': 'sprite_graphics', 'sprite_deltas': 'sprite_graphics',
+    }
+
+    def parse(self):
+        """ Parses what is needed to draw the map: header, animations and palettes. """
+        for name in self.lazy_attributes:
+            self.__dict__.pop(name, None)
         self.parse_header()
-        self.parse_blocks()
+        self.sections = self.section_ranges()
+        for name in ['blocks', 'clut', 'pal_index', 'palette']:
+            if name in self.sections:
+                self.parse_section(name)
+
+    def __getattr__(self, name):
+        # Only called for missing attributes.
+        section = self.lazy_attributes.get(name)
+        if section is None or 'sections' not in self.__dict__:
+            raise AttributeError(name)
+        self.parse_section(section)
+        return self.__dict__[name]
+
+    def parse_section(self, name):
+        self.offset = self.sections[name][0]
+        dict(self.section_parsers())[name]()
+
+    def section_ranges(self):
+        """ Returns where each section is in the file: name -> (start, end) """
+        h = self.header
+        num_tiles = h['side_size'] // 4096 + h['lid_size'] // 4096 + h['aux_size'] // 4096
+        sizes = [('blocks', (num_tiles + (4 - num_tiles % 4) % 4) * 4096 + h['anim_size'])]
+        if self.version == 336: # G24
+            paged_clut_size = h['clut_size']
+            if paged_clut_size % 65536 != 0:
+                paged_clut_size += (65536 - (paged_clut_size % 65536))
+            sizes += [('clut', paged_clut_size), ('pal_index', h['palette_index_size'])]
+        else: # GRY
+            sizes += [('palette', h['palette_size'] + h['remap_size'] + h['remap_index_size'])]
+        sizes += [('object_info', h['object_info_size']), ('car_info', h['car_size']), ('sprite_info', h['sprite_info_size']),
+                  ('sprite_graphics', h['sprite_graphics_size'] + h['sprite_numbers_size'])]
+        sections = {}
+        offset = self.offset
+        for name, size in sizes:
+            sections[name] = (offset, offset + size)
+            offset += size
+        return sections
+
+    def section_parsers(self):
         if self.version == 336: # G24
-            self.parse_clut()
-            self.parse_pal_index()
+            palettes = [('clut', self.parse_clut), ('pal_index', self.parse_pal_index)]
         else: # GRY
-            self.parse_palette_and_remaps()
-        self.parse_object_info()
-        self.parse_car_info()
-        self.parse_sprite_info()
-        self.parse_sprite_graphics()
+            palettes = [('palette', self.parse_palette_and_remaps)]
+        return [('blocks', self.parse_blocks)] + palettes + [
+            ('object_info', self.parse_object_info), ('car_info', self.parse_car_info),
+            ('sprite_info', self.parse_sprite_info), ('sprite_graphics', self.parse_sprite_graphics),
+        ]
+
+    def reload(self, data):
+        """ Reparses only the sections that differ in data (the new content of the file).
+
+        Returns the names of the changed sections and the indices of the changed tiles
+        (side, lid and aux blocks numbered contiguously), or None if the layout of the
+        file changed, in which case everything was reparsed.
+        """
+        old_data, old_header = self.data, self.header
+        self.data = data
+        self.parse_header()
+        if self.header != old_header or len(data) != len(old_data):
+            self.parse()
+            return None
+        changed, tiles = [], set()
+        for name, parse in self.section_parsers():
+            start, end = self.sections[name]
+            if old_data[start:end] == data[start:end]:
+                continue
+            changed.append(name)
+            if name == 'blocks':
+                tiles = self.reparse_blocks(old_data)
+            elif name in self.lazy_attributes.values():
+                # Parsed again on next access.
+                for attr, section in self.lazy_attributes.items():
+                    if section == name:
+                        self.__dict__.pop(attr, None)
+            else:
+                self.parse_section(name)
+            if name == 'sprite_info':
+                # The deltas are decoded with the sprite graphics, at the positions given by the sprite info.
+                self.__dict__.pop('sprite_deltas', None)
+        return changed, tiles
+
+    def reparse_blocks(self, old_data):
+        """ Deinterleaves again the rows of 4 tiles that changed and parses the animations, returns the changed tiles. """
+        tiles = set()
+        row_size = 4 * 4096
+        for row in range(self.num_tiles // 4):
+            start = self.tiles_offset + row * row_size
+            if old_data[start:start + row_size] == self.data[start:start + row_size]:
+                continue
+            tiles.update(range(row * 4, row * 4 + 4))
+            if self.tile_pixels is not None:
+                if not self.tile_pixels.flags.writeable:
+                    # Still a view on the bytes of the previous file.
+                    self.tile_pixels = self.tile_pixels.copy()
+                self.tile_pixels[row * 4:row * 4 + 4] = self.deinterleave_blocks(self.data, start, 4)
+        self.offset = self.tiles_offset + self.num_tiles * 4096
+        self.parse_anim()
+        return tiles
 
     def parse_header(self):
         self.version = struct.unpack('<I', self.data[0:4])[0]
@@ -77,20 +263,20 @@ class G24Parser:
         self.offset += self.header['remap_size']
         self.remap_index = self.data[self.offset : self.offset + self.header['remap_index_size']]
         self.offset += self.header['remap_index_size']
+        self.build_palettes()
+
+    def deinterleave_blocks(self, data, offset, count):
+        """ Tiles are stored 4 by 4, interleaved line by line: returns them as a (count, 64, 64) array. """
+        pages = np.frombuffer(data, dtype=np.uint8, count=count * 4096, offset=offset).reshape(count // 4, 64, 4, 64)
+        return pages.transpose(0, 2, 1, 3).reshape(count, 64, 64)
+
+    def get_tile_pixels(self):
+        if self.tile_pixels is None:
+            self.tile_pixels = self.deinterleave_blocks(self.data, self.tiles_offset, self.num_tiles)
+        return self.tile_pixels
 
-    def deinterleave_blocks(self, data, count):
-        blocks = [[0]*4096 for _ in range(count)]
-        rows = count // 4
-        for r in range(rows):
-            for line in range(64):
-                base_idx = (r * 64 + line) * 256
-                row_data = data[base_idx : base_idx + 256]
-                for b in range(4):
-                    block_idx = r * 4 + b
-                    line_data = row_data[b*64 : (b+1)*64]
-                    start = line * 64
-                    blocks[block_idx][start : start + 64] = line_data
-        return blocks
+    def get_tile(self, t):
+        return self.get_tile_pixels()[t]
 
     def parse_blocks(self):
         num_side = self.header['side_size'] // 4096
@@ -100,14 +286,15 @@ class G24Parser:
         padding_blocks = (4 - (total_blocks % 4)) % 4
         total_slots = total_blocks + padding_blocks
 
-        size = total_slots * 4096
-        raw_blocks_data = self.data[self.offset : self.offset + size]
-        self.offset += size
+        # Tiles are only deinterleaved when they are first used.
+        self.tiles_offset = self.offset
+        self.num_tiles = total_slots
+        self.tile_pixels = None
+        self.offset += total_slots * 4096
 
-        all_blocks = self.deinterleave_blocks(raw_blocks_data, total_slots)
-        self.side_blocks = all_blocks[:num_side]
-        self.lid_blocks = all_blocks[num_side : num_side + num_lid]
-        self.aux_blocks = all_blocks[num_side + num_lid : num_side + num_lid + num_aux]
+        self.side_blocks = TileList(self, 0, num_side)
+        self.lid_blocks = TileList(self, num_side, num_lid)
+        self.aux_blocks = TileList(self, num_side + num_lid, num_aux)
 
         self.parse_anim()
 
@@ -134,6 +321,7 @@ class G24Parser:
             paged_clut_size += (65536 - (paged_clut_size % 65536))
         self.clut_data = self.data[self.offset : self.offset + paged_clut_size]
         self.offset += paged_clut_size
+        self.build_palettes()
 
     def parse_pal_index(self):
         size = self.header['palette_index_size']
@@ -204,20 +392,21 @@ class G24Parser:
                 w, h, dc, v = struct.unpack('<B B B B', self.data[curr:curr+4])
                 sz, clut, xoff, yoff, page = struct.unpack('<H H B B H', self.data[curr+4:curr+12])
                 curr += 12
-                for _ in range(dc):
-                    curr += 6
+                # (size, ptr) of each delta, ptr is an offset in the sprite graphics.
+                deltas = [struct.unpack_from('<H I', self.data, curr + 6 * i) for i in range(dc)]
+                curr += 6 * dc
                 self.sprite_info.append({
                     'w': w, 'h': h, 'clut': clut, 'page': page,
-                    'xoff': xoff, 'yoff': yoff, 'dc': dc
+                    'xoff': xoff, 'yoff': yoff, 'dc': dc, 'deltas': deltas
                 })
             else: # GRY
                 w, h, dc, v = struct.unpack('<B B B B', self.data[curr:curr+4])
                 sz, ptr = struct.unpack('<H I', self.data[curr+4:curr+10])
                 curr += 10
-                for _ in range(dc):
-                    curr += 6
+                deltas = [struct.unpack_from('<H I', self.data, curr + 6 * i) for i in range(dc)]
+                curr += 6 * dc
                 self.sprite_info.append({
-                    'w': w, 'h': h, 'dc': dc, 'ptr': ptr
+                    'w': w, 'h': h, 'dc': dc, 'ptr': ptr, 'deltas': deltas
                 })
         self.offset = end
 
@@ -226,6 +415,7 @@ class G24Parser:
         self.sprite_graphics = self.data[self.offset : self.offset + size]
         self.offset += size
         self.parse_sprite_numbers()
+        self.sprite_deltas = self.decode_sprite_deltas()
 
     def parse_sprite_numbers(self):
         size = self.header['sprite_numbers_size']
@@ -247,6 +437,38 @@ class G24Parser:
                 self.sprite_bases[name] = current_base
                 current_base += vals[i]
 
+    def decode_sprite_deltas(self):
+        """ Decodes all the deltas of the sprites: (sprite, delta) -> pixels changed as (x, y, color) arrays.
+
+        A delta is a list of runs: a 16 bits offset from the end of the previous run
+        (in the 256 pixels wide page), a length and the colors of the run.
+        """
+        graphics = self.sprite_graphics
+        sprite_deltas = {}
+        for spr_num, info in enumerate(self.sprite_info):
+            for delta, (size, ptr) in enumerate(info['deltas']):
+                data = graphics[ptr : ptr + size]
+                positions, colors = [], b''
+                pos, curr = 0, 0
+                while curr + 3 <= len(data):
+                    offset, length = struct.unpack_from('<H B', data, curr)
+                    run = data[curr + 3 : curr + 3 + length]
+                    pos += offset
+                    positions.extend(range(pos, pos + len(run)))
+                    colors += run
+                    pos += length
+                    curr += 3 + length
+                positions = np.array(positions, dtype=np.int32)
+                x, y = positions % 256, positions // 256
+                inside = (x < info['w']) & (y < info['h'])
+                sprite_deltas[spr_num, delta] = x[inside], y[inside], np.frombuffer(colors, dtype=np.uint8)[inside]
+        return sprite_deltas
+
+    def get_sprite_delta(self, spr_num, delta):
+        """ Returns the pixels changed by a delta of a sprite as (x, y, color) arrays, none if it has no such delta. """
+        empty = np.zeros(0, dtype=np.int32)
+        return self.sprite_deltas.get((spr_num, delta), (empty, empty, empty.astype(np.uint8)))
+
     def get_color(self, clut_idx, color_idx):
         if self.version == 336: # G24
             page = clut_idx // 64
@@ -271,11 +493,39 @@ class G24Parser:
             a = 255 if color_idx != 0 else 0
             return (r, g, b, a)
 
+    def build_palettes(self):
+        """ Decodes all the palettes at once in self.palettes, a (N, 256, 4) RGBA array (same colors as get_color). """
+        if self.version == 336: # G24
+            # Pages of 64 palettes, the colors of all the palettes of a page are interleaved.
+            pages = (len(self.clut_data) + 65535) // 65536
+            data = np.zeros(pages * 65536, dtype=np.uint8)
+            data[:len(self.clut_data)] = np.frombuffer(self.clut_data, dtype=np.uint8)
+            bgra = data.reshape(pages, 256, 64, 4).transpose(0, 2, 1, 3).reshape(pages * 64, 256, 4)
+            palettes = bgra[:, :, [2, 1, 0, 3]]
+            clut, color = np.indices(palettes.shape[:2])
+            missing = (clut // 64) * 65536 + color * 256 + (clut % 64) * 4 + 3 > len(self.clut_data)
+        else: # GRY
+            # The palettes are the remap tables applied to the VGA palette (6 bits per component).
+            vga = np.zeros((256, 3), dtype=np.int32)
+            vga.flat[:len(self.palette)] = np.frombuffer(self.palette, dtype=np.uint8)[:768]
+            remaps = np.frombuffer(self.remap_tables, dtype=np.uint8)
+            count = (len(remaps) + 255) // 256
+            indices = np.zeros(count * 256, dtype=np.int32)
+            indices[:len(remaps)] = remaps
+            palettes = np.zeros((count, 256, 4), dtype=np.uint8)
+            palettes[:, :, :3] = (vga[indices] * 4).reshape(count, 256, 3).astype(np.uint8)
+            missing = (np.arange(count * 256) >= len(remaps)).reshape(count, 256)
+        palettes[:, :, 3] = 255
+        palettes[:, 0, 3] = 0
+        palettes[missing] = 0
+        self.palettes = np.ascontiguousarray(palettes)
+        self.no_palette = np.zeros((256, 4), dtype=np.uint8)
+
     def get_palette(self, clut_idx):
-        pal = []
-        for i in range(256):
-            pal.append(self.get_color(clut_idx, i))
-        return pal
+        """ Returns the palette as a (256, 4) RGBA array. """
+        if clut_idx >= len(self.palettes):
+            return self.no_palette
+        return self.palettes[clut_idx]
 
 class CMPParser:
     def __init__(self, filepath):
@@ -321,7 +571,11 @@ class CMPParser:
         self.objects = sorted(self.objects, key=lambda obj: -obj['z'])
         offset += obj_size
         offset += self.header['route_size']
-        offset += 108 # location_data (3x6x6)
+        # location_data: 6 (x, y, z) for each group, (0, 0, 0) when unused.
+        self.locations = {}
+        for group in ['police', 'hospital', 'unused1', 'unused2', 'fire', 'unused3']:
+            self.locations[group] = [tuple(self.data[offset + 3 * i : offset + 3 * i + 3]) for i in range(6)]
+            offset += 18
         nav_size = self.header['nav_data_size']
         self.nav_data = []
         stride = 35
@@ -438,16 +692,1014 @@ slope_to_delta = {
     44: (1, 0, 1, 0),
 }
 
+# Same as slope_to_delta as an array indexed by slope type (the 6 bits of the field, unused
+# ones are flat), with the corners in the order used for drawing: TL, TR, BR, BL.
+slope_corners = [(0, 0, 0, 0)] * 64
+for slope_type, deltas in slope_to_delta.items():
+    slope_corners[slope_type] = deltas[0], deltas[1], deltas[3], deltas[2]
+
+class FrameStats:
+    """ Per-frame timings of each rendering phase, together with some counters.
+
+    Timings of a phase are accumulated between start() and stop() (a phase can
+    run several times per frame, e.g. once per level) until end_frame(), which
+    stores them in the history and optionally appends them to a CSV file.
+    """
+    phases = ['events', 'sides', 'lids', 'objects', 'player', 'hud', 'flip']
+    counters = ['faces', 'blits', 'cache_misses']
+    colors = {
+        'events': (200, 200, 200), 'sides': (220, 60, 60), 'lids': (60, 200, 60), 'objects': (60, 120, 240),
+        'player': (240, 200, 40), 'hud': (200, 60, 200), 'flip': (60, 220, 220),
+    }
+
+    def __init__(self, history=300, log_file=None):
+        self.history = collections.deque(maxlen=history)
+        self.frame = 0
+        self.log = None
+        if log_file:
+            self.log = open(log_file, 'w', newline='')
+            self.writer = csv.writer(self.log)
+            self.writer.writerow(['frame'] + [f"{phase}_ms" for phase in self.phases] + ['total_ms'] + self.counters)
+        self.begin_frame()
+
+    def begin_frame(self):
+        self.times = dict.fromkeys(self.phases, 0.0)
+        self.counts = dict.fromkeys(self.counters, 0)
+        self.started = {}
+
+    def start(self, phase):
+        self.started[phase] = time.perf_counter()
+
+    def stop(self, phase):
+        self.times[phase] += time.perf_counter() - self.started.pop(phase)
+
+    def count(self, counter, n=1):
+        self.counts[counter] += n
+
+    def end_frame(self):
+        self.history.append((self.times, self.counts))
+        if self.log:
+            ms = [1000 * self.times[phase] for phase in self.phases]
+            self.writer.writerow([self.frame] + [f"{t:.3f}" for t in ms] + [f"{sum(ms):.3f}"] + [self.counts[c] for c in self.counters])
+        self.frame += 1
+        self.begin_frame()
+
+    def close(self):
+        if self.log:
+            self.log.close()
+            self.log = None
+
+    def draw(self, screen, font, x, y, width=300, height=150, ms_per_height=50):
+        """ Draws a stacked graph of the phases of the last frames, most recent on the right. """
+        bg = pygame.Surface((width, height + 20 + font.get_linesize() * (len(self.phases) + 1)))
+        bg.fill((0, 0, 0))
+        bg.set_alpha(180)
+        screen.blit(bg, (x, y))
+        frames = list(self.history)[-width:]
+        px_per_s = height * 1000 / ms_per_height
+        for i, (times, _) in enumerate(frames):
+            bar_x = x + width - len(frames) + i
+            bottom = y + height
+            for phase in self.phases:
+                h = times[phase] * px_per_s
+                if h >= 1:
+                    pygame.draw.line(screen, self.colors[phase], (bar_x, bottom), (bar_x, max(y, bottom - h)))
+                bottom -= h
+                if bottom <= y:
+                    break
+        # 60 and 30 FPS
+        for ms in [1000/60, 1000/30]:
+            line_y = y + height - ms * px_per_s / 1000
+            pygame.draw.line(screen, (255, 255, 255), (x, line_y), (x + width, line_y))
+        text_y = y + height + 10
+        for phase in self.phases:
+            avg = 1000 * sum(times[phase] for times, _ in frames) / max(1, len(frames))
+            screen.blit(font.render(f"{phase:8} {avg:6.2f} ms", True, self.colors[phase]), (x + 10, text_y))
+            text_y += font.get_linesize()
+        if frames:
+            counts = frames[-1][1]
+            text = '  '.join(f"{c}: {counts[c]}" for c in self.counters)
+            screen.blit(font.render(text, True, (255, 255, 255)), (x + 10, text_y))
+
+class FrameRecorder:
+    """ Records the displayed frames without slowing down the display.
+
+    Each frame is copied in a ring buffer of preallocated images and a thread writes
+    them, either as numbered PNG files in a directory, or as a raw RGB24 video stream
+    if path ends with .rgb (e.g. ffmpeg -f rawvideo -pix_fmt rgb24 -s WxH -r 60 -i
+    path out.mp4). When the writer is behind and the buffer is full, frames are dropped.
+    """
+    def __init__(self, path, width, height, buffer_size=32):
+        self.path = path
+        self.raw = path.lower().endswith('.rgb')
+        if self.raw:
+            self.out = open(path, 'wb')
+        else:
+            os.makedirs(path, exist_ok=True)
+        self.buffer = np.empty((buffer_size, height, width, 3), dtype=np.uint8)
+        self.free = queue.Queue()
+        for slot in range(buffer_size):
+            self.free.put(slot)
+        self.pending = queue.Queue()
+        self.frame = 0
+        self.written = 0
+        self.dropped = 0
+        self.paused = False
+        self.writer = threading.Thread(target=self.write_frames, daemon=True)
+        self.writer.start()
+
+    def capture(self, surface):
+        if self.paused:
+            return
+        self.frame += 1
+        try:
+            slot = self.free.get_nowait()
+        except queue.Empty:
+            self.dropped += 1
+            return
+        if surface.get_size() != self.buffer.shape[2:0:-1]:
+            # The window size changed, the video can't follow.
+            self.free.put(slot)
+            self.dropped += 1
+            return
+        self.buffer[slot] = pygame.surfarray.pixels3d(surface).swapaxes(0, 1)
+        self.pending.put((slot, self.frame))
+
+    def write_frames(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            slot, frame = item
+            if self.raw:
+                self.out.write(self.buffer[slot].tobytes())
+            else:
+                cv2.imwrite(os.path.join(self.path, f"frame_{frame:06}.png"), cv2.cvtColor(self.buffer[slot], cv2.COLOR_RGB2BGR))
+            self.written += 1
+            self.free.put(slot)
+
+    def close(self):
+        """ Waits for all the captured frames to be written. """
+        self.pending.put(None)
+        self.writer.join()
+        if self.raw:
+            self.out.close()
+        print(f"Recorded {self.written} frames to {self.path}, {self.dropped} dropped")
+
+class InputRecorder:
+    """ Records the inputs of play mode, one game cycle at a time, in 8 bytes records like the REP files (see REP.md).
+
+    Each record is the game cycle (uint32) from which the inputs (uint32) apply, the
+    inputs being a bit mask of the held INPUT_KEYS and of the INPUT_ACTIONS pressed
+    just before this cycle. A record is only written when the held keys change or
+    when an action is pressed, and the last one marks the end of the recording.
+    """
+    def __init__(self, path):
+        self.out = open(path, 'wb')
+        self.held = None
+        self.cycle = 0
+
+    def record(self, cycle, inputs):
+        # Actions only apply to the cycle of their record, so they are always written.
+        if inputs & ~INPUT_HELD or inputs & INPUT_HELD != self.held:
+            self.out.write(struct.pack('<I I', cycle, inputs))
+            self.held = inputs & INPUT_HELD
+        self.cycle = cycle + 1
+
+    def close(self):
+        if not self.out.closed:
+            self.out.write(struct.pack('<I I', self.cycle, 0))
+            self.out.close()
+
+class InputPlayer:
+    """ Plays back the inputs recorded by an InputRecorder. """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.records = list(struct.iter_unpack('<I I', data[:len(data) // 8 * 8]))
+        # Game cycle at which the recording ends.
+        self.end = self.records[-1][0] if self.records else 0
+        self.next = 0
+        self.inputs = 0
+
+    def get(self, cycle):
+        """ Returns the inputs of a game cycle, cycles being played in order. """
+        actions = 0
+        while self.next < len(self.records) and self.records[self.next][0] <= cycle:
+            record_cycle, self.inputs = self.records[self.next]
+            # Actions only apply to the cycle they were recorded for.
+            actions = self.inputs if record_cycle == cycle else 0
+            self.next += 1
+        return self.inputs & INPUT_HELD | actions & ~INPUT_HELD
+
+class Crowd:
+    """ Pedestrians walking on the pavements, all simulated at once.
+
+    The pedestrians are stored as arrays with one entry per pedestrian (x, y,
+    level, rotation, ...) and step() updates all of them with numpy operations.
+    To avoid each other, they are bucketed by block in a spatial hash: sorted
+    by block, the ones of block k being order[start[k]:start[k + 1]].
+    """
+    # Pedestrians looked at per neighbouring block, so that a crowded block doesn't make a step quadratic.
+    max_per_block = 4
+
+    def __init__(self, walkable, count, seed=0):
+        """ walkable is a (256, 256) array of the level of the pavement of each block, -1 where there is none. """
+        self.walkable = walkable
+        self.rng = np.random.default_rng(seed)
+        cells = np.argwhere(walkable >= 0)
+        if len(cells) == 0:
+            count = 0
+        cells = cells[self.rng.integers(max(1, len(cells)), size=count)]
+        self.x = cells[:, 1] + self.rng.random(count)
+        self.y = cells[:, 0] + self.rng.random(count)
+        self.z = walkable[cells[:, 0], cells[:, 1]]
+        # In degrees, 0 is walking south, like the player.
+        self.rotation = self.rng.random(count) * 360
+        # Pedestrian remap, 0 for none.
+        self.remap = self.rng.integers(65, size=count)
+        # Walking animation, the pedestrians are not all on the same frame.
+        self.phase = self.rng.integers(8, size=count)
+        self.frame = self.phase.copy()
+        self.clock = 0
+        self.build_hash()
+
+    def __len__(self):
+        return len(self.x)
+
+    def build_hash(self):
+        keys = self.y.astype(np.int32) * 256 + self.x.astype(np.int32)
+        self.order = np.argsort(keys, kind='stable')
+        self.start = np.zeros(256 * 256 + 1, dtype=np.int64)
+        np.cumsum(np.bincount(keys, minlength=256 * 256), out=self.start[1:])
+
+    def avoidance(self):
+        """ Returns how much each pedestrian is pushed by its neighbours, in x and y. """
+        push_x, push_y = np.zeros(len(self)), np.zeros(len(self))
+        bx, by = self.x.astype(np.int32), self.y.astype(np.int32)
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                nx, ny = bx + dx, by + dy
+                inside = (nx >= 0) & (nx < 256) & (ny >= 0) & (ny < 256)
+                key = np.where(inside, ny * 256 + nx, 0)
+                first = self.start[key]
+                count = np.where(inside, self.start[key + 1] - first, 0)
+                for k in range(self.max_per_block):
+                    other = self.order[np.minimum(first + k, len(self) - 1)]
+                    ox, oy = self.x - self.x[other], self.y - self.y[other]
+                    d2 = ox * ox + oy * oy
+                    near = (count > k) & (d2 > 0) & (d2 < CROWD_RADIUS * CROWD_RADIUS)
+                    # The closer, the harder the push.
+                    strength = np.where(near, CROWD_RADIUS / np.sqrt(np.maximum(d2, 1e-9)) - 1, 0)
+                    push_x += ox * strength
+                    push_y += oy * strength
+        return push_x, push_y
+
+    def step(self):
+        """ Advances all the pedestrians by one game cycle. """
+        if len(self) == 0:
+            return
+        self.clock += 1
+        # Wander around.
+        self.rotation += self.rng.normal(0, 5, len(self))
+        angle = np.radians(self.rotation)
+        push_x, push_y = self.avoidance()
+        vx = CROWD_WALK_SPEED * (np.sin(angle) + push_x)
+        vy = CROWD_WALK_SPEED * (np.cos(angle) + push_y)
+        x, y = self.x + vx, self.y + vy
+        # Stay on the pavements of the same level, turn around when reaching their edge.
+        inside = (x >= 0) & (x < 256) & (y >= 0) & (y < 256)
+        bx, by = np.clip(x, 0, 255).astype(np.int32), np.clip(y, 0, 255).astype(np.int32)
+        moved = inside & (self.walkable[by, bx] == self.z)
+        self.x = np.where(moved, x, self.x)
+        self.y = np.where(moved, y, self.y)
+        turned = self.rotation + 180 + self.rng.uniform(-45, 45, len(self))
+        self.rotation = np.where(moved, np.degrees(np.arctan2(vx, vy)), turned) % 360
+        # 8 walking frames, one every 2 game cycles like the player.
+        self.frame = (self.clock // 2 + self.phase) % 8
+        self.build_hash()
+
+class Traffic:
+    """ Cars driving along the roads, all simulated at once.
+
+    The lanes are a graph extracted once from the direction bits of the road blocks:
+    each road block is a node, linked to the neighbouring road blocks of the same
+    level in the directions allowed by its bits. A car drives from the center of a
+    block (node) to the center of a neighbouring one (target) in direction dir,
+    progress being how far it is on the way. Cars are stored as arrays, one entry
+    per car, and step() updates all of them with numpy operations. A car only
+    enters a block when no other car is driving to it, so they queue instead of
+    overlapping.
+    """
+    def __init__(self, levels, directions, cars, count, seed=0):
+        """ levels is a (256, 256) array of the level of the road of each cell, -1 where there is none,
+        directions the direction bits of these roads and cars the car models (car_info index) to use.
+        """
+        self.rng = np.random.default_rng(seed)
+        cells = np.argwhere(levels >= 0)
+        self.node_y, self.node_x = cells[:, 0], cells[:, 1]
+        nodes = np.full((256, 256), -1, dtype=np.int64)
+        nodes[self.node_y, self.node_x] = np.arange(len(cells))
+        # neighbours[node, direction] is the node in that direction, -1 if there is no road.
+        self.neighbours = np.full((len(cells), 4), -1, dtype=np.int64)
+        for d, (dx, dy) in enumerate(DIRECTIONS):
+            nx, ny = self.node_x + dx, self.node_y + dy
+            inside = (nx >= 0) & (nx < 256) & (ny >= 0) & (ny < 256)
+            nx, ny = np.where(inside, nx, 0), np.where(inside, ny, 0)
+            road = inside & (levels[ny, nx] == levels[self.node_y, self.node_x])
+            self.neighbours[:, d] = np.where(road, nodes[ny, nx], -1)
+        bits = directions[self.node_y, self.node_x]
+        self.allowed = np.stack([(bits >> d) & 1 == 1 for d in range(4)], axis=1) & (self.neighbours >= 0)
+        self.level = levels[self.node_y, self.node_x]
+        self.moves = np.array(DIRECTIONS)
+        self.rotations = np.array(DIRECTION_ROTATIONS)
+        self.reverse = np.array([1, 0, 3, 2])
+
+        # Spawn the cars on different blocks, going to different blocks.
+        start = np.nonzero(self.allowed.any(axis=1))[0]
+        start = self.rng.permutation(start)[:count]
+        dirs = self.choose(self.allowed[start])
+        _, first = np.unique(self.neighbours[start, dirs], return_index=True)
+        first.sort()
+        self.node, self.dir = start[first], dirs[first]
+        self.target = self.neighbours[self.node, self.dir]
+        count = len(self.node)
+        self.progress = self.rng.random(count)
+        self.speed = TRAFFIC_SPEED * self.rng.uniform(0.75, 1.25, count)
+        self.car = np.array(cars)[self.rng.integers(len(cars), size=count)] if cars else np.zeros(count, dtype=np.int64)
+        # Car remap, 0 for none.
+        self.remap = self.rng.integers(13, size=count)
+        self.update_positions()
+        self.previous_x, self.previous_y = self.x, self.y
+
+    def __len__(self):
+        return len(self.node)
+
+    def choose(self, allowed):
+        """ Picks one of the allowed directions at random for each row, -1 if there is none. """
+        scores = np.where(allowed, self.rng.random(allowed.shape), -1)
+        return np.where(allowed.any(axis=1), scores.argmax(axis=1), -1)
+
+    def update_positions(self):
+        move = self.moves[self.dir]
+        self.x = self.node_x[self.node] + 0.5 + move[:, 0] * self.progress
+        self.y = self.node_y[self.node] + 0.5 + move[:, 1] * self.progress
+
+    def step(self):
+        """ Advances all the cars by one game cycle. """
+        if len(self) == 0:
+            return
+        self.previous_x, self.previous_y = self.x, self.y
+        self.progress = self.progress + self.speed
+        arrived = np.nonzero(self.progress >= 1)[0]
+        if len(arrived):
+            node = self.target[arrived]
+            # Don't make a U-turn unless it's the only way.
+            allowed = self.allowed[node]
+            ahead = allowed.copy()
+            ahead[np.arange(len(arrived)), self.reverse[self.dir[arrived]]] = False
+            allowed = np.where(ahead.any(axis=1)[:, np.newaxis], ahead, allowed)
+            # On a dead end (for the direction bits), turn around anyway.
+            allowed = np.where(allowed.any(axis=1)[:, np.newaxis], allowed, self.neighbours[node] >= 0)
+            dirs = self.choose(allowed)
+            target = np.where(dirs >= 0, self.neighbours[node, dirs], -1)
+            # Only enter blocks no car is driving to, and only one car per block.
+            taken = np.zeros(len(self.allowed) + 1, dtype=bool)
+            taken[self.target] = True
+            free = (target >= 0) & ~taken[target]
+            _, first = np.unique(np.where(free, target, -1 - np.arange(len(arrived))), return_index=True)
+            go = np.zeros(len(arrived), dtype=bool)
+            go[first] = free[first]
+            moving = arrived[go]
+            self.node[moving], self.dir[moving], self.target[moving] = node[go], dirs[go], target[go]
+            self.progress[moving] -= 1
+            # The others wait at the end of their way.
+            self.progress[arrived[~go]] = 1
+        self.update_positions()
+
+    def positions(self, alpha):
+        """ Returns the positions of the cars between the last 2 game cycles (alpha from 0 to 1). """
+        return self.previous_x + (self.x - self.previous_x) * alpha, self.previous_y + (self.y - self.previous_y) * alpha
+
+class Vehicles:
+    """ Dynamics of the cars, the player's and the AI's ones, all integrated at once.
+
+    The handling of each car comes from its car_info: the descriptors (speeds,
+    acceleration, braking, grip) are taken as pixels per game cycle, 64 per block,
+    and the fixed point values (mass, thrust, adhesion, frictions, ...) are
+    converted like modify_gry.convert_float. Cars are stored as arrays, one entry
+    per car: the controls (throttle, steer, handbrake) are set for each car, by the
+    keys or by an AI, then step() moves all of them with numpy operations.
+
+    As described in game_mechanic.md, cars turn on a circle which doesn't depend on
+    their speed, smaller going backward or with the handbrake, and drift when their
+    tyres can't hold the turn.
+    """
+    def __init__(self, car_info, cars):
+        """ cars are the car models (car_info index) of the cars, which start stopped at (0, 0). """
+        self.car = np.array(cars, dtype=np.int64)
+        def values(name):
+            return np.array([car_info[car][name] for car in cars], dtype=np.float64)
+        def pixels(name):
+            return values(name) / 64
+        def fixed(name):
+            return values(name) / FIXED_ONE
+        mass = np.maximum(fixed('rbp_mass'), 1 / FIXED_ONE)
+        self.max_speed, self.min_speed = pixels('max_speed'), -np.abs(pixels('min_speed'))
+        # What the tyres hold before the wheels spin or lock (traction) or the car slides (cornering).
+        self.traction = pixels('grip') * fixed('tyre_adhesion_y')
+        self.cornering = 4 * pixels('grip') * fixed('tyre_adhesion_x')
+        self.engine = np.minimum(pixels('acceleration') * fixed('g1_thrust') / mass, self.traction)
+        self.footbrake = np.minimum(pixels('braking'), self.traction)
+        self.handbrake_braking = np.minimum(pixels('braking') * fixed('handbrake_friction') / mass, self.traction)
+        # Friction slowing down the car to a stop when it's neither accelerating nor braking.
+        self.rolling = fixed('footbrake_friction') / 64
+        # Braking with the rear wheels and the handbrake make them lose their side grip.
+        self.braking_grip = np.clip(fixed('front_brake_bias'), 0, 1)
+        self.handbrake_grip = np.clip(1 - fixed('handbrake_slide_value'), 0, 1)
+        # Rotation in degrees per block driven, and how fast the car follows it, heavier cars lagging more.
+        self.turn = values('turn_ratio') / 8
+        self.response = np.clip(64 * values('handling') / np.maximum(values('moment'), 1), 0.1, 1)
+        # Rotation in degrees per block of sliding, when the back end of the car swings out.
+        self.back_end = fixed('back_end_slide_value') * 64
+
+        count = len(self.car)
+        self.x, self.y, self.rotation = np.zeros(count), np.zeros(count), np.zeros(count)
+        # Speed forward and to the left in blocks per game cycle, and rotation in degrees per game cycle.
+        self.speed, self.slide, self.spin = np.zeros(count), np.zeros(count), np.zeros(count)
+        # Controls, from -1 to 1: throttle is forward, steer is left.
+        self.throttle, self.steer = np.zeros(count), np.zeros(count)
+        self.handbrake = np.zeros(count, dtype=bool)
+
+    def __len__(self):
+        return len(self.car)
+
+    def step(self):
+        """ Advances all the cars by one game cycle. """
+        if len(self) == 0:
+            return
+        # Pulling back while going forward (or the opposite) brakes.
+        braking = self.throttle * self.speed < 0
+        drive = np.where(braking, 0, self.throttle * self.engine)
+        brake = np.where(braking, np.abs(self.throttle) * self.footbrake, 0) + np.where(self.handbrake, self.handbrake_braking, 0)
+        coasting = (self.throttle == 0) & ~self.handbrake
+        brake = np.minimum(brake, self.traction) + np.where(coasting, self.rolling, 0)
+        speed = self.speed * np.where(coasting, 1 - CAR_DRAG, 1) + drive
+        speed = np.clip(np.sign(speed) * np.maximum(np.abs(speed) - brake, 0), self.min_speed, self.max_speed)
+
+        turn = self.turn * np.where(speed < 0, CAR_REVERSE_TURN, 1) * np.where(self.handbrake, CAR_HANDBRAKE_TURN, 1)
+        spin = self.spin + (self.steer * speed * turn - self.spin) * self.response
+        before, after = np.radians(self.rotation), np.radians(self.rotation + spin)
+        # The car keeps going the same way while it turns, the tyres only hold part of it.
+        vx = speed * np.sin(before) + self.slide * np.cos(before)
+        vy = speed * np.cos(before) - self.slide * np.sin(before)
+        speed = vx * np.sin(after) + vy * np.cos(after)
+        slide = vx * np.cos(after) - vy * np.sin(after)
+        grip = self.cornering * np.where(braking, self.braking_grip, 1) * np.where(self.handbrake, self.handbrake_grip, 1)
+        slide = np.sign(slide) * np.maximum(np.abs(slide) - grip, 0)
+        self.spin = spin
+        self.rotation = np.degrees(after) - slide * self.back_end
+        self.speed, self.slide = speed, slide
+        self.x = self.x + speed * np.sin(after) + slide * np.cos(after)
+        self.y = self.y + speed * np.cos(after) - slide * np.sin(after)
+
+    def hit_walls(self, nx, ny):
+        """ Stops the cars going into walls, given the normals of their contacts ((0, 0) for none).
+
+        Only the part of the velocity going into the wall is lost: a car scraping along
+        a wall keeps its speed along it, and its slide.
+        """
+        angle = np.radians(self.rotation)
+        vx = self.speed * np.sin(angle) + self.slide * np.cos(angle)
+        vy = self.speed * np.cos(angle) - self.slide * np.sin(angle)
+        into = np.minimum(vx * nx + vy * ny, 0)
+        vx, vy = vx - into * nx, vy - into * ny
+        self.speed = vx * np.sin(angle) + vy * np.cos(angle)
+        self.slide = vx * np.cos(angle) - vy * np.sin(angle)
+
+class Dispatch:
+    """ Sends the emergency services (police, ambulances, fire engines) from their bases to incidents.
+
+    The blocks where they can drive (roads and pavements) are a graph, each block being
+    linked to its neighbours at most one level above or below. The distance to each
+    base of the CMP locations is computed once for all the blocks, breadth first, so
+    that the nearest base of an incident is a lookup, for any number of incidents at
+    once, and its route is found by going down the distances from the incident.
+    """
+    def __init__(self, levels, locations):
+        """ levels is a (256, 256) array of the level of the blocks where the services drive, -1 where they can't,
+        locations the groups of bases of CMPParser.locations.
+        """
+        cells = np.argwhere(levels >= 0)
+        self.node_y, self.node_x = cells[:, 0], cells[:, 1]
+        nodes = np.full((256, 256), -1, dtype=np.int64)
+        nodes[self.node_y, self.node_x] = np.arange(len(cells))
+        # neighbours[node, direction] is the node in that direction, -1 if the services can't drive there.
+        self.neighbours = np.full((len(cells), 4), -1, dtype=np.int64)
+        for d, (dx, dy) in enumerate(DIRECTIONS):
+            nx, ny = self.node_x + dx, self.node_y + dy
+            inside = (nx >= 0) & (nx < 256) & (ny >= 0) & (ny < 256)
+            nx, ny = np.where(inside, nx, 0), np.where(inside, ny, 0)
+            linked = inside & (levels[ny, nx] >= 0) & (np.abs(levels[ny, nx] - levels[self.node_y, self.node_x]) <= 1)
+            self.neighbours[:, d] = np.where(linked, nodes[ny, nx], -1)
+        # Incidents off the roads are reached from the closest node.
+        self.closest = self.closest_nodes(nodes)
+        # For each service: the bases, the distance (in blocks) of each node to each of them,
+        # and the nearest base of each node with its distance, -1 when none can reach it.
+        self.bases, self.distances, self.nearest, self.distance = {}, {}, {}, {}
+        for service in SERVICES:
+            bases = [(x, y) for x, y, z in locations.get(service, []) if (x, y, z) != (0, 0, 0)]
+            self.bases[service] = bases
+            distances = np.array([self.distances_from(self.closest[y, x]) for x, y in bases]).reshape(len(bases), len(cells))
+            self.distances[service] = distances
+            reachable = np.where(distances >= 0, distances, np.iinfo(np.int64).max)
+            nearest = reachable.argmin(axis=0) if len(bases) else np.zeros(len(cells), dtype=np.int64)
+            self.distance[service] = distances[nearest, np.arange(len(cells))] if len(bases) else np.full(len(cells), -1)
+            self.nearest[service] = np.where(self.distance[service] >= 0, nearest, -1)
+
+    def closest_nodes(self, nodes):
+        """ Returns the closest node of each cell (in blocks, diagonals included), -1 if there is no node at all. """
+        closest = nodes.copy()
+        while (closest < 0).any() and (closest >= 0).any():
+            grown = closest.copy()
+            for dx, dy in DIRECTIONS + [(-1, -1), (1, -1), (-1, 1), (1, 1)]:
+                source = closest[max(dy, 0):256 + min(dy, 0), max(dx, 0):256 + min(dx, 0)]
+                target = grown[max(-dy, 0):256 + min(-dy, 0), max(-dx, 0):256 + min(-dx, 0)]
+                np.copyto(target, source, where=(target < 0) & (source >= 0))
+            closest = grown
+        return closest
+
+    def distances_from(self, start):
+        """ Returns the distance in blocks of each node to the start node, -1 where it can't be reached. """
+        distances = np.full(len(self.neighbours), -1, dtype=np.int64)
+        if start < 0:
+            return distances
+        frontier, distance = np.array([start]), 0
+        while len(frontier):
+            distances[frontier] = distance
+            reached = self.neighbours[frontier].ravel()
+            frontier = np.unique(reached[reached >= 0])
+            frontier = frontier[distances[frontier] < 0]
+            distance += 1
+        return distances
+
+    def dispatch(self, service, x, y):
+        """ Returns, for incidents at blocks (x, y), the nearest base (index in self.bases[service])
+        and its distance in blocks, -1 for both when no base can reach them.
+        """
+        node = self.closest[np.asarray(y) % 256, np.asarray(x) % 256]
+        found = node >= 0
+        node = np.where(found, node, 0)
+        return np.where(found, self.nearest[service][node], -1), np.where(found, self.distance[service][node], -1)
+
+    def route(self, service, base, x, y):
+        """ Returns the blocks (x, y) to drive through from a base to the incident at (x, y), [] if it can't be reached. """
+        node = self.closest[int(y) % 256, int(x) % 256]
+        distances = self.distances[service][base]
+        if node < 0 or distances[node] < 0:
+            return []
+        path = [node]
+        while distances[node] > 0:
+            neighbours = self.neighbours[node]
+            neighbours = neighbours[neighbours >= 0]
+            node = neighbours[distances[neighbours] == distances[node] - 1][0]
+            path.append(node)
+        return [(int(self.node_x[node]), int(self.node_y[node])) for node in reversed(path)]
+
+class CollisionGrid:
+    """ Collisions of boxes (cars, pedestrians, ...) with the blocks of the map.
+
+    Which blocks are solid and the height of the slopes are computed once from the
+    blocks of the map. A box at level z collides with the solid blocks of level z
+    and stands on the blocks of level z + 1 (or on a slope of level z).
+
+    Boxes are given as arrays, one entry per box, and are all checked at once: a
+    box is only checked against the blocks under its bounding box (broadphase),
+    with the separating axis theorem.
+    """
+    def __init__(self, block_grid, block_types, block_flats, block_slopes, slope_corners):
+        blocks = np.maximum(block_grid, 0)
+        exists = block_grid >= 0
+        self.solid = exists & np.isin(block_types[blocks], SOLID_TYPES) & (block_flats[blocks] == 0) & (block_slopes[blocks] == 0)
+        # Blocks which can be stood on.
+        self.floor = exists & (block_types[blocks] != 0)
+        self.sloped = exists & (block_slopes[blocks] != 0)
+        # Level of the (TL, TR, BR, BL) corners of the lids, relative to the level of their block.
+        self.corners = slope_corners.astype(np.float32)[np.where(exists, block_slopes[blocks], 0)]
+
+    def ground_level(self, x, y, z):
+        """ Returns the level of the ground under (x, y) for boxes at level z: z + 1 on flat ground, less on slopes. """
+        bx, by = np.clip(x, 0, 255).astype(np.int32), np.clip(y, 0, 255).astype(np.int32)
+        fx, fy = x - bx, y - by
+        def lid(level):
+            corners = self.corners[level, by, bx]
+            top = corners[..., 0] * (1 - fx) + corners[..., 1] * fx
+            bottom = corners[..., 3] * (1 - fx) + corners[..., 2] * fx
+            return level + top * (1 - fy) + bottom * fy
+        below = np.minimum(z + 1, 5)
+        on_ground = z < 5
+        return np.where(self.sloped[z, by, bx], lid(z),
+               np.where(on_ground & self.sloped[below, by, bx], lid(below),
+               np.where(on_ground & self.floor[below, by, bx], z + 1, z + 2)))
+
+    def collide(self, x, y, z, half_width, half_height, rotation):
+        """ Returns the contacts of the boxes with the solid blocks as (box, normal x, normal y, penetration) arrays.
+
+        The normal is the direction in which to move the box out of the block, by
+        penetration blocks. Width is along x and height along y for a rotation of
+        0, the box moving towards its height (sin(rotation), cos(rotation)) like the player.
+        """
+        angle = np.radians(rotation)
+        # Axes of the boxes: sideways and forward.
+        side = np.stack([np.cos(angle), -np.sin(angle)], axis=-1)
+        forward = np.stack([np.sin(angle), np.cos(angle)], axis=-1)
+        # Half size of the bounding boxes.
+        extent_x = np.abs(side[:, 0]) * half_width + np.abs(forward[:, 0]) * half_height
+        extent_y = np.abs(side[:, 1]) * half_width + np.abs(forward[:, 1]) * half_height
+        # Broadphase: the blocks around the center, as far as the biggest bounding box goes.
+        reach = int(np.ceil(max(extent_x.max(initial=0), extent_y.max(initial=0))))
+        offsets = np.arange(-reach, reach + 1)
+        bx = np.floor(x).astype(np.int32)[:, np.newaxis, np.newaxis] + offsets[np.newaxis, np.newaxis, :]
+        by = np.floor(y).astype(np.int32)[:, np.newaxis, np.newaxis] + offsets[np.newaxis, :, np.newaxis]
+        bx, by = np.broadcast_arrays(bx, by)
+        bx, by = bx.reshape(len(x), -1), by.reshape(len(x), -1)
+        inside = (bx >= 0) & (bx < 256) & (by >= 0) & (by < 256)
+        candidate = inside & self.solid[z[:, np.newaxis], np.clip(by, 0, 255), np.clip(bx, 0, 255)]
+        # Only the blocks overlapping the bounding boxes.
+        candidate &= (bx < x[:, np.newaxis] + extent_x[:, np.newaxis]) & (bx + 1 > x[:, np.newaxis] - extent_x[:, np.newaxis])
+        candidate &= (by < y[:, np.newaxis] + extent_y[:, np.newaxis]) & (by + 1 > y[:, np.newaxis] - extent_y[:, np.newaxis])
+        box, cell = np.nonzero(candidate)
+        # Separating axis theorem, on the axes of the blocks (x, y) and of the boxes (side, forward).
+        dx = x[box] - (bx[box, cell] + 0.5)
+        dy = y[box] - (by[box, cell] + 0.5)
+        axes = np.stack([np.broadcast_to([1.0, 0.0], (len(box), 2)), np.broadcast_to([0.0, 1.0], (len(box), 2)), side[box], forward[box]], axis=1)
+        # Projections of the half sizes of the boxes and of the blocks (half size 0.5) on each axis.
+        box_radius = half_width[box, np.newaxis] * np.abs((axes * side[box, np.newaxis]).sum(axis=-1)) + \
+                     half_height[box, np.newaxis] * np.abs((axes * forward[box, np.newaxis]).sum(axis=-1))
+        block_radius = 0.5 * (np.abs(axes[..., 0]) + np.abs(axes[..., 1]))
+        distance = axes[..., 0] * dx[:, np.newaxis] + axes[..., 1] * dy[:, np.newaxis]
+        overlap = box_radius + block_radius - np.abs(distance)
+        touching = (overlap > 0).all(axis=1)
+        # Faces shared with another solid block are inside a wall, boxes are not pushed out through them.
+        normals = axes * np.where(distance < 0, -1, 1)[..., np.newaxis]
+        along_x = np.abs(normals[..., 0]) >= np.abs(normals[..., 1])
+        cell_x = bx[box, cell, np.newaxis] + np.where(along_x, np.where(normals[..., 0] < 0, -1, 1), 0)
+        cell_y = by[box, cell, np.newaxis] + np.where(along_x, 0, np.where(normals[..., 1] < 0, -1, 1))
+        inside = (cell_x >= 0) & (cell_x < 256) & (cell_y >= 0) & (cell_y < 256)
+        inner = inside & self.solid[z[box, np.newaxis], np.clip(cell_y, 0, 255), np.clip(cell_x, 0, 255)]
+        overlap = np.where(inner, np.inf, overlap)
+        best = overlap.argmin(axis=1)
+        rows = np.arange(len(box))
+        normal = normals[rows, best]
+        # Boxes surrounded by solid blocks can't be pushed out.
+        touching &= np.isfinite(overlap[rows, best])
+        return box[touching], normal[touching, 0], normal[touching, 1], overlap[rows, best][touching]
+
+    def resolve(self, x, y, z, half_width, half_height, rotation, iterations=2):
+        """ Moves the boxes out of the solid blocks, along the deepest contact each time.
+
+        Returns the new positions and the normal of the contacts of each box: the
+        direction in which it was moved out, (0, 0) for the boxes without contact.
+        """
+        x, y = np.array(x, dtype=float), np.array(y, dtype=float)
+        push_x, push_y = np.zeros(len(x)), np.zeros(len(x))
+        for _ in range(iterations):
+            box, nx, ny, depth = self.collide(x, y, z, half_width, half_height, rotation)
+            if len(box) == 0:
+                break
+            # Deepest contact of each box.
+            order = np.argsort(-depth, kind='stable')
+            boxes, first = np.unique(box[order], return_index=True)
+            deepest = order[first]
+            x[boxes] += nx[deepest] * depth[deepest]
+            y[boxes] += ny[deepest] * depth[deepest]
+            push_x[boxes] += nx[deepest] * depth[deepest]
+            push_y[boxes] += ny[deepest] * depth[deepest]
+        length = np.hypot(push_x, push_y)
+        length = np.where(length > 0, length, 1)
+        return x, y, push_x / length, push_y / length
+
+class World:
+    """ The game mechanics: the map, the style tables and the state of the player, the crowd, the traffic, ...
+
+    It doesn't display anything nor use pygame, so that scripts and tests can simulate
+    many game cycles faster than real time, e.g. walking forward for 10 seconds:
+        world = World(CMPParser(cmp_file), G24Parser(style_file))
+        world.show_player = 1
+        world.step(INPUT_UP, 10000)
+    MapRenderer draws it and feeds it the keys pressed in play mode, see MapRenderer.step_inputs.
+    Positions are in blocks, speeds per game cycle.
+    """
+    def __init__(self, cmp, g24, crowd=0, traffic=0):
+        self.cmp, self.g24 = cmp, g24
+        # Game cycles simulated, and time left to simulate in ms (less than a cycle).
+        self.cycle = 0
+        self.time_left = 0
+        self.index_blocks()
+        self.crowd = Crowd(self.surface_levels(PAVEMENT), crowd) if crowd else None
+        self.traffic = Traffic(*self.road_lanes(), self.traffic_cars(), traffic) if traffic else None
+        # Built when first used, see emergency_services().
+        self.services = None
+        # 0 = no, 1 = pedestrian, 2 = car
+        self.show_player = 0
+        self.player_x, self.player_y = 0.0, 0.0
+        self.player_sprite = 0
+        self.player_height = 4
+        self.player_rotation = 0
+        self.player_weapon = 0  # 0=fist, 1=pistol, 2=machine gun, 3=rocket launcher, 4=flamethrower, 5=petrol bomb
+        self.player_remap = 0
+        # Deltas (damages, opened doors, ...) applied to the car, as a bit mask.
+        self.player_deltas = 0
+        self.car_speed = 0
+        # Dynamics of the player's car, see step_player().
+        self.player_car = None
+
+    def reload_map(self, cmp):
+        """ Updates the blocks from a new version of the map, returns what changed. """
+        old, self.cmp = self.cmp, cmp
+        changed = []
+        if old.base != self.cmp.base or old.column_data != self.cmp.column_data or len(old.block_data) != len(self.cmp.block_data):
+            changed.append('columns')
+            self.index_blocks()
+        elif old.block_data != self.cmp.block_data:
+            blocks = [idx for idx in range(len(self.blocks)) if old.block_data[idx * 8:idx * 8 + 8] != self.cmp.block_data[idx * 8:idx * 8 + 8]]
+            changed.append(f"{len(blocks)} blocks")
+            for idx in blocks:
+                self.blocks[idx] = self.cmp.get_block(idx)
+                self.block_slopes[idx] = self.blocks[idx]['slope']
+                self.block_lids[idx] = self.blocks[idx]['lid']
+                self.block_lid_remaps[idx] = self.blocks[idx]['lid_remap']
+                self.block_lights[idx] = self.blocks[idx]['traffic_lights']
+                self.block_types[idx] = self.blocks[idx]['blocktype']
+                self.block_directions[idx] = sum(self.blocks[idx]['directions'].values())
+                self.block_flats[idx] = self.blocks[idx]['flat']
+            self.index_traffic_lights()
+            self.collision = CollisionGrid(self.block_grid, self.block_types, self.block_flats, self.block_slopes, self.slope_corners)
+        if changed and self.crowd is not None:
+            self.crowd = Crowd(self.surface_levels(PAVEMENT), len(self.crowd))
+        if changed and self.traffic is not None:
+            self.traffic = Traffic(*self.road_lanes(), self.traffic_cars(), len(self.traffic))
+        if changed or old.locations != self.cmp.locations:
+            self.services = None
+        return changed
+
+    def index_blocks(self):
+        """ Parses all the blocks and columns of the map once.
+
+        self.block_grid[z, y, x] is the index in self.blocks of the block at level z of cell (x, y), or -1.
+        """
+        self.blocks = [self.cmp.get_block(idx) for idx in range(len(self.cmp.block_data) // 8)]
+        self.slope_corners = np.array(slope_corners)
+        self.block_slopes = np.array([block['slope'] for block in self.blocks], dtype=np.int32)
+        self.block_lids = np.array([block['lid'] for block in self.blocks], dtype=np.int32)
+        self.block_lid_remaps = np.array([block['lid_remap'] for block in self.blocks], dtype=np.int32)
+        self.block_lights = np.array([block['traffic_lights'] for block in self.blocks], dtype=np.int32)
+        self.block_types = np.array([block['blocktype'] for block in self.blocks], dtype=np.int32)
+        self.block_directions = np.array([sum(block['directions'].values()) for block in self.blocks], dtype=np.int32)
+        self.block_flats = np.array([block['flat'] for block in self.blocks], dtype=np.int32)
+        self.block_grid = np.full((6, 256, 256), -1, dtype=np.int32)
+        for y in range(256):
+            for x in range(256):
+                col_offset = self.cmp.base[y * 256 + x]
+                if col_offset >= len(self.cmp.column_data):
+                    continue
+                height = struct.unpack_from('<H', self.cmp.column_data, col_offset)[0]
+                blk_idx = struct.unpack_from('<' + 'H' * (6 - height), self.cmp.column_data, col_offset + 2)
+                self.block_grid[height:, y, x] = blk_idx
+        self.index_traffic_lights()
+        self.collision = CollisionGrid(self.block_grid, self.block_types, self.block_flats, self.block_slopes, self.slope_corners)
+
+    def index_traffic_lights(self):
+        """ Finds all the traffic lights of the map once.
+
+        They are the blocks with traffic light bits 1 (the other values are for trains).
+        The lights are stored as arrays (light_x, light_y, light_z, ...) so that the
+        state of all of them is updated at once, see update_traffic_lights.
+        """
+        z, y, x = np.nonzero((self.block_grid >= 0) & (self.block_lights[self.block_grid] == 1))
+        self.light_x, self.light_y, self.light_z = x, y, z
+        # Like in the game, they are drawn high above the street: one level above their block.
+        self.light_levels = np.maximum(z - 1, 0)
+        # Lights of east-west roads are half a cycle late compared to the ones of north-south roads.
+        east_west = np.array([self.blocks[blk_idx]['directions']['left'] or self.blocks[blk_idx]['directions']['right']
+                              for blk_idx in self.block_grid[z, y, x].tolist()], dtype=bool)
+        self.light_offsets = np.where(east_west, len(TRAFFIC_LIGHT_CYCLE) // 2, 0)
+        self.light_rotations = np.where(east_west, 90, 0)
+        self.light_cycle = np.array(TRAFFIC_LIGHT_CYCLE, dtype=np.int32)
+        self.update_traffic_lights()
+
+    def surface_levels(self, block_type):
+        """ Returns the level of the surface of each cell as a (256, 256) array, -1 where it is not of block_type.
+
+        The surface is the highest block of the column that is not air.
+        """
+        types = np.where(self.block_grid >= 0, self.block_types[self.block_grid], 0)
+        solid = types != 0
+        top = solid.argmax(axis=0)
+        found = solid.any(axis=0) & (np.take_along_axis(types, top[np.newaxis], axis=0)[0] == block_type)
+        return np.where(found, top, -1)
+
+    def road_lanes(self):
+        """ Returns the level of the road of each cell, -1 where there is none, and the direction bits of these roads. """
+        levels = self.surface_levels(ROAD)
+        blocks = np.take_along_axis(self.block_grid, np.maximum(levels, 0)[np.newaxis], axis=0)[0]
+        return levels, np.where(levels >= 0, self.block_directions[blocks], 0)
+
+    def emergency_services(self):
+        """ Returns the Dispatch of the emergency services of the map, they drive on the roads and the pavements. """
+        if self.services is None:
+            self.services = Dispatch(np.maximum(self.surface_levels(ROAD), self.surface_levels(PAVEMENT)), self.cmp.locations)
+        return self.services
+
+    def traffic_cars(self):
+        """ Returns the cars (indices in car_info) of the traffic: cars, buses and bikes. """
+        return [idx for idx, car in enumerate(self.g24.car_info) if car['vtype'] in (0, 3, 4)]
+
+    def update_traffic_lights(self):
+        """ Computes the state of all the traffic lights for the current game cycle. """
+        self.light_states = self.light_cycle[(self.cycle + self.light_offsets) % len(self.light_cycle)]
+
+    def step(self, inputs=0, dt=SIM_TICK_MS):
+        """ Advances the world by dt ms, one game cycle (SIM_TICK_MS) at a time, returns the number of cycles.
+
+        inputs are the INPUT_* bits of the player's controls, the actions only apply to the first cycle.
+        """
+        self.time_left += dt
+        cycles = 0
+        while self.time_left >= SIM_TICK_MS:
+            self.time_left -= SIM_TICK_MS
+            if self.show_player > 0:
+                self.step_player(inputs if cycles == 0 else inputs & INPUT_HELD)
+            self.step_agents()
+            cycles += 1
+        return cycles
+
+    def step_player(self, inputs):
+        """ Moves the player by one game cycle given its inputs. """
+        vrotate = 15 # rotation speed
+        walk_speed = 0.03
+        run_speed = 0.09
+        self.play_actions(inputs)
+        if self.show_player == 1:
+            self.player_sprite = 21  # standing still
+            if inputs & INPUT_LEFT:
+                self.player_rotation += vrotate
+            if inputs & INPUT_RIGHT:
+                self.player_rotation -= vrotate
+            if inputs & INPUT_UP:
+                self.player_sprite = 1  # running
+                angle = 2*math.pi*self.player_rotation/360
+                dx, dy = run_speed * math.sin(angle), run_speed * math.cos(angle)
+                self.player_x += dx
+                self.player_y += dy
+            if inputs & INPUT_DOWN:
+                self.player_sprite = 0  # walking
+                angle = 2*math.pi*self.player_rotation/360
+                dx, dy = walk_speed * math.sin(angle), walk_speed * math.cos(angle)
+                self.player_x -= dx
+                self.player_y -= dy
+            if inputs & INPUT_FIRE:
+                # 10: Punching still
+                # 18: Pistol still
+                # 22: Pistol backward
+                # 23: Pistol forward
+                # 25: Flame-thrower backward
+                # 26: Flame-thrower forward
+                # 27: Flame-thrower still
+                # 28: Machine-gun backward
+                # 29: Machine-gun forward
+                # 30: Machine-gun still
+                # 31: Rocket launcher backward
+                # 32: Rocket launcher forward
+                # 33: Rocket launcher still
+                # 36: Punching forward
+                if self.player_weapon == 0: # Punching
+                    if self.player_sprite == 21:
+                        self.player_sprite = 10  # Punching still
+                    elif self.player_sprite == 1:
+                        self.player_sprite = 36  # Punching forward
+                    # No punching backward
+                elif self.player_weapon == 1: # Pistol
+                    if self.player_sprite == 21:
+                        self.player_sprite = 18  # Pistol still
+                    elif self.player_sprite == 1:
+                        self.player_sprite = 23  # Pistol forward
+                    elif self.player_sprite == 0:
+                        self.player_sprite = 22  # Pistol backward
+                elif self.player_weapon == 2: # Machine gun
+                    if self.player_sprite == 21:
+                        self.player_sprite = 30  # Machine gun still
+                    elif self.player_sprite == 1:
+                        self.player_sprite = 29  # Machine gun forward
+                    elif self.player_sprite == 0:
+                        self.player_sprite = 28  # Machine gun backward
+                elif self.player_weapon == 3: # Rocket launcher
+                    if self.player_sprite == 21:
+                        self.player_sprite = 33  # Rocket launcher still
+                    elif self.player_sprite == 1:
+                        self.player_sprite = 32  # Rocket launcher forward
+                    elif self.player_sprite == 0:
+                        self.player_sprite = 31  # Rocket launcher backward
+                elif self.player_weapon == 4: # Flame-thrower
+                    if self.player_sprite == 21:
+                        self.player_sprite = 27  # Flame-thrower still
+                    elif self.player_sprite == 1:
+                        self.player_sprite = 26  # Flame-thrower forward
+                    elif self.player_sprite == 0:
+                        self.player_sprite = 25  # Flame-thrower backward
+                elif self.player_weapon == 5: # Petrol bomb: no sprites!
+                    pass
+        elif self.show_player == 2:
+            if self.player_car is None or self.player_car.car[0] != self.player_sprite:
+                self.player_car = Vehicles(self.g24.car_info, [self.player_sprite])
+            # The player can be moved by the collisions or by switching modes, the car follows it.
+            car = self.player_car
+            car.x[0], car.y[0], car.rotation[0], car.speed[0] = self.player_x, self.player_y, self.player_rotation, self.car_speed
+            car.throttle[0] = bool(inputs & INPUT_UP) - bool(inputs & INPUT_DOWN)
+            car.steer[0] = bool(inputs & INPUT_LEFT) - bool(inputs & INPUT_RIGHT)
+            car.handbrake[0] = bool(inputs & INPUT_HANDBRAKE)
+            car.step()
+            self.player_x, self.player_y = float(car.x[0]), float(car.y[0])
+            self.player_rotation, self.car_speed = float(car.rotation[0]), float(car.speed[0])
+        if self.show_player > 0:
+            self.collide_player()
+        # TODO: Zoom/dezoom depending on the speed
+        # TODO: React based on the tile: slow down on fields, ...
+        if self.player_rotation > 360:
+            self.player_rotation -= 360
+        if self.player_rotation < -360:
+            self.player_rotation += 360
+
+    def step_agents(self):
+        """ Advances everything but the player by one game cycle. """
+        if self.crowd is not None:
+            self.crowd.step()
+        if self.traffic is not None:
+            self.traffic.step()
+        self.cycle += 1
+        self.update_traffic_lights()
+
+    def play_actions(self, inputs):
+        """ Applies the actions of the inputs, the keys pressed once. """
+        if inputs & INPUT_SWITCH:
+            self.show_player = 2 if self.show_player == 1 else 1
+        if inputs & INPUT_NEXT_CAR:
+            # Switch to the next car model
+            if self.show_player == 2 and self.player_sprite + 1 < len(self.g24.car_info):
+                self.player_sprite += 1
+                self.player_deltas = 0
+        if inputs & INPUT_PREVIOUS_CAR:
+            # Switch to previous car model
+            if self.show_player == 2 and self.player_sprite > 0:
+                self.player_sprite -= 1
+                self.player_deltas = 0
+        if inputs & INPUT_NEXT_WEAPON:
+            self.player_weapon = (self.player_weapon + 1) % 6
+        if inputs & INPUT_PREVIOUS_WEAPON:
+            self.player_weapon = (self.player_weapon - 1) % 6
+
+    def collide_player(self):
+        """ Pushes the player out of the solid blocks, and makes it go up and down the slopes. """
+        x, y, z = np.array([self.player_x]), np.array([self.player_y]), np.array([self.player_height])
+        if self.show_player == 2:
+            # Car sizes are in pixels, 64 per block.
+            car_info = self.g24.car_info[self.player_sprite]
+            half_width, half_height = car_info['width'] / 128, car_info['height'] / 128
+        else:
+            half_width = half_height = PEDESTRIAN_HALF_SIZE
+        x, y, nx, ny = self.collision.resolve(x, y, z, np.array([half_width]), np.array([half_height]), np.array([self.player_rotation]))
+        self.player_x, self.player_y = float(x[0]), float(y[0])
+        if (nx[0] or ny[0]) and self.show_player == 2:
+            # Against a building: the car keeps going along the wall.
+            self.player_car.speed[0] = self.car_speed
+            self.player_car.hit_walls(nx, ny)
+            self.car_speed = float(self.player_car.speed[0])
+        # Change of level once more than half way up or down a slope, or when falling.
+        ground = float(self.collision.ground_level(x, y, z)[0])
+        if ground < self.player_height + 0.5 and self.player_height > 0:
+            self.player_height -= 1
+        elif ground > self.player_height + 1.5 and self.player_height < 5:
+            self.player_height += 1
+
+
 class MapRenderer:
-    def __init__(self, cmp_file, g24_file, show_objects=True, show_tiles=True, show_sides=True, show_lids=True, min_z=0, max_z=6, width=1024, height=768, fullscreen=False):
+    def __init__(self, cmp_file, g24_file, show_objects=True, show_tiles=True, show_sides=True, show_lids=True, min_z=0, max_z=6, width=1024, height=768, fullscreen=False, headless=False, frame_log=None, render_threads=1, lod_threshold=16, record=None, timing=False, crowd=0, traffic=0, record_inputs=None, replay=None):
+        # Startup steps and when they ended, printed after the first frame with timing.
+        self.timing = timing
+        self.startup = []
+        self.mark_startup('imports')
+        self.cmp_file, self.g24_file = cmp_file, g24_file
         self.cmp = CMPParser(cmp_file)
         self.g24 = G24Parser(g24_file)
+        self.mark_startup('parsing')
+        # Input files are reloaded when they change: path -> (mtime, size)
+        self.file_stamps = {path: self.file_stamp(path) for path in [cmp_file, g24_file]}
         self.show_objects = show_objects
         self.show_tiles = show_tiles
         self.show_sides = show_sides
         self.show_lids = show_lids
         self.min_z, self.max_z = min_z, max_z
-        self.screen_width, self.screen_height = width, height
+        self.set_view_size(width, height)
         self.ui_scale = min(width/640, width/480)
         self.view_x, self.view_y = -4.0, -4.0
         #self.view_x, self.view_y = 128.0, 128.0
@@ -456,49 +1708,267 @@ class MapRenderer:
         self.base_tile_size = 64
         self.base_scale = 2.0
         self.clicked_x, self.clicked_y = 0, 0
-        self.display_tiles_h = int(self.screen_width / 64 + 1)  # Number of tiles to display horizontally
-        self.display_tiles_v = int(self.screen_height / 64 + 1)  # Number of tiles to display vertically
         self.scale_factor = 0.1
         self.surface_cache = {}
         self.sprite_cache = {}
+        # Sprites with deltas and riders: (sprite, remap, deltas, rider) -> surface.
+        self.composite_cache = {}
+        # Pixels of the (flipped) side surfaces, for the multi-threaded rasterizer.
+        self.face_arrays = {}
+        self.render_threads = render_threads
+        self.render_pool = ThreadPoolExecutor(render_threads) if render_threads > 1 else None
+        # Below this number of pixels per block, the map is drawn with one color per column.
+        self.lod_threshold = lod_threshold
+        # Mean color of the lids and of their animation frames: (type name, block, remap) -> (r, g, b)
+        self.lid_colors = {}
+        # Color of the columns as a 256x256 surface: (levels, apply remaps) -> (surface, lid * 4 + remap of each column)
+        self.lod_surfaces = {}
+        self.world = World(self.cmp, self.g24, crowd, traffic)
+        # The player is drawn there, see run().
+        self.world.player_x, self.world.player_y = self.view_x + 10, self.view_y + 8
+        self.index_animations()
+        # Position of the rendered frame between the last 2 game cycles.
+        self.sim_alpha = 1.0
+        # Objects are resolved when first drawn, see index_objects.
+        self.level_objects = None
+        self.object_cache = {}
+        self.mark_startup('indexing')
+        self.stats = FrameStats(log_file=frame_log)
         self.fullscreen = fullscreen
+        self.headless = headless
+        self.offscreen = None
         # Pre-generate a grid of A, B coordinates (0 to 63)
         # This avoids re-creating the coordinate space every call
         self.A_grid, self.B_grid = np.meshgrid(np.arange(64), np.arange(64), indexing='ij')
         self.AB_grid = self.A_grid * self.B_grid
+        if headless:
+            # The dummy driver lets pygame create surfaces and fonts without any window.
+            os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
         pygame.init()
         self.font = pygame.font.SysFont('monospace', 24, bold=True)
+        self.small_font = pygame.font.SysFont('monospace', 14, bold=True)
+        # Rendered texts and backgrounds of the HUD, most of them don't change between frames.
+        self.text_cache = {}
+        self.background_cache = {}
+        self.minimap = None
         self.clock = pygame.time.Clock()
         self.init_display()
+        self.recorder = FrameRecorder(record, self.screen_width, self.screen_height) if record else None
+        # Inputs of play mode recorded to or played back from a file, see step_inputs().
+        self.input_recorder = InputRecorder(record_inputs) if record_inputs else None
+        self.input_player = InputPlayer(replay) if replay else None
+        # Game cycles simulated in play mode.
+        self.play_cycle = 0
         self.apply_remaps = True
         self.play_mode = False
+        if self.input_recorder or self.input_player:
+            # Recordings start with play mode, as when pressing F2.
+            self.play_mode = True
+            self.world.show_player = 1
+        self.mark_startup('display')
+
+    def mark_startup(self, step):
+        self.startup.append((step, time.perf_counter()))
+
+    def print_startup(self):
+        steps = []
+        previous = START_TIME
+        for step, t in self.startup:
+            steps.append(f"{step}: {1000 * (t - previous):.1f} ms")
+            previous = t
+        print(f"Time to first frame: {1000 * (previous - START_TIME):.1f} ms ({', '.join(steps)})")
+
+    def set_view_size(self, width, height):
+        self.screen_width, self.screen_height = width, height
+        self.display_tiles_h = int(self.screen_width / 64 + 1)  # Number of tiles to display horizontally
+        self.display_tiles_v = int(self.screen_height / 64 + 1)  # Number of tiles to display vertically
 
     def init_display(self):
-        if self.fullscreen:
+        if self.headless:
+            self.screen = pygame.Surface((self.screen_width, self.screen_height))
+        elif self.fullscreen:
             self.screen = pygame.display.set_mode((self.screen_width, self.screen_height), pygame.FULLSCREEN | pygame.SCALED)
         else:
             self.screen = pygame.display.set_mode((self.screen_width, self.screen_height))
 
-    def get_animated_block(self, block_idx, which, ticks):
+    def file_stamp(self, path):
+        st = os.stat(path)
+        return st.st_mtime_ns, st.st_size
+
+    def check_files(self):
+        """ Reloads the input files that were modified since they were last loaded. """
+        for path, reload in [(self.cmp_file, self.reload_map), (self.g24_file, self.reload_style)]:
+            try:
+                stamp = self.file_stamp(path)
+            except OSError:
+                # Some tools delete and re-create the file, try again later.
+                continue
+            if stamp == self.file_stamps[path]:
+                continue
+            self.file_stamps[path] = stamp
+            start = time.perf_counter()
+            try:
+                what = reload()
+            except (struct.error, IndexError, ValueError) as e:
+                # Probably read while being written, it will be reloaded on the next write.
+                print(f"WARNING: Failed to reload {path}: {e}")
+                continue
+            print(f"Reloaded {path} ({what}) in {1000 * (time.perf_counter() - start):.1f} ms")
+
+    def reload_style(self):
+        with open(self.g24_file, 'rb') as f:
+            data = f.read()
+        result = self.g24.reload(data)
+        # The colors of the zoomed out map and the minimap are cheap to rebuild.
+        self.lod_surfaces = {}
+        self.minimap = None
+        if result is None:
+            self.surface_cache = {}
+            self.sprite_cache = {}
+            self.lid_colors = {}
+            self.composite_cache = {}
+            self.index_animations()
+            self.level_objects = None
+            self.face_arrays = {}
+            self.world.player_car = None
+            return "everything"
+        changed, tiles = result
+        if set(changed) & {'clut', 'pal_index', 'palette'}:
+            self.surface_cache = {}
+            self.sprite_cache = {}
+            self.lid_colors = {}
+        elif tiles:
+            num_side, num_lid = len(self.g24.side_blocks), len(self.g24.lid_blocks)
+            def tile(type_name, idx):
+                return {'side': idx, 'lid': num_side + idx, 'aux': num_side + num_lid + idx}[type_name]
+            self.surface_cache = {key: surf for key, surf in self.surface_cache.items() if tile(key[0], key[1]) not in tiles}
+            self.lid_colors = {key: color for key, color in self.lid_colors.items() if tile(key[0], key[1]) not in tiles}
+        if set(changed) & {'clut', 'pal_index', 'palette', 'sprite_info', 'sprite_graphics'}:
+            self.sprite_cache = {}
+            self.composite_cache = {}
+            self.object_cache = {}
+        if 'blocks' in changed:
+            self.index_animations()
+        if set(changed) & {'object_info', 'car_info', 'sprite_graphics'}:
+            self.level_objects = None
+        if 'car_info' in changed:
+            self.world.player_car = None
+        surfaces = set(self.surface_cache.values())
+        self.face_arrays = {key: arrays for key, arrays in self.face_arrays.items() if key[0] in surfaces}
+        return ', '.join(changed) + (f" - {len(tiles)} tiles" if tiles else "")
+
+    def reload_map(self):
+        old = self.cmp
+        self.cmp = CMPParser(self.cmp_file)
+        changed = self.world.reload_map(self.cmp)
+        if old.objects != self.cmp.objects:
+            changed.append('objects')
+            self.level_objects = None
+        self.lod_surfaces = {}
+        self.minimap = None
+        return ', '.join(changed) or "no change"
+
+    def index_animations(self):
+        # Animations are looked up for every face drawn, index them by (block, which).
+        self.animations = {}
         for anim in self.g24.animations:
-            if anim['block'] == block_idx and anim['which'] == which:
-                total_frames = anim['frame_count']# + 1
-                # 1 game cycle == 1/20th of a second
-                frame_idx = (ticks // (max(1, anim['speed']) * 1000 // 20)) % total_frames
-                if frame_idx == 0:
-                    return False, block_idx
-                else:
-                    return True, anim['frames'][frame_idx - 1]
-        return False, block_idx
-
-    def get_tile_surface(self, type_name, idx, ticks=0, remap=0):
-        which = 1 if type_name == 'lid' else 0
-        aux, idx = self.get_animated_block(idx, which, ticks)
-        if aux:
-            type_name = 'aux'
+            self.animations.setdefault((anim['block'], anim['which']), anim)
+        # Current frame of each animation: (block, which) -> (aux, block to draw).
+        self.anim_frames = {}
+        self.anim_ticks = None
+
+    def index_objects(self):
+        """ Resolves the objects of the map once, they only depend on the map and the style.
+
+        self.level_objects maps a level to the list of objects to draw on it, as
+        (x, y, z, sprite number, frame count, frame duration in ms, rotation in degrees).
+        """
+        self.car_models = {}
+        for car in self.g24.car_info:
+            self.car_models.setdefault(car['model'], car)
+        # Sprite of each car of car_info, for the traffic.
+        self.car_sprites = np.array([car['spr_num'] + self.g24.sprite_bases[self.vehicle_type_const(car['vtype'])]
+                                     for car in self.g24.car_info], dtype=np.int32)
+        self.level_objects = collections.defaultdict(list)
+        for obj in self.cmp.objects:
+            ox, oy, oz = obj['x']/64.0, obj['y']/64.0, (obj['z']+1)/64.0
+            frames, duration = 1, 1
+            if obj['remap'] >= 128:
+                info = self.car_models.get(obj['type'])
+                if info is None:
+                    print(f"ERROR: Car model not found: {obj['type']}")
+                    continue
+                base_name = self.vehicle_type_const(info['vtype'])
+                spr_num = self.g24.sprite_bases.get(base_name, 0) + info['spr_num']
+            else:
+                o_idx = obj['type']
+                if o_idx >= len(self.g24.object_info):
+                    print(f"ERROR: Object not found: {o_idx}")
+                    continue
+                info = self.g24.object_info[o_idx]
+                if info['status'] == 3:  # invisible
+                    continue
+                spr_num = self.g24.sprite_bases.get('object', 0) + info['spr_num']
+                if info['status'] == 5 or info['status'] == 9:
+                    frames = 8
+                    if info['status'] == 5:
+                        frames = info['width']
+                    speed = info['height']
+                    duration = max(1, (speed * 1000 // 60))
+            self.level_objects[int(oz)].append((ox, oy, oz, spr_num, frames, duration, obj['rotation'] * 90 / 256))
+        # Scaled and rotated sprites: (sprite number, size, rotation) -> surface.
+        self.object_cache = {}
+
+    def get_object_surface(self, spr_num, scale, rotation, remap=-1):
+        spr_surf = self.get_sprite_surface(spr_num, remap)
+        if not spr_surf:
+            return None
+        size = (max(1, int(spr_surf.get_width()*scale)), max(1, int(spr_surf.get_height()*scale)))
+        key = (spr_num, size, rotation, remap)
+        if key not in self.object_cache:
+            # Zooming creates new sizes for all sprites, don't keep the old ones forever.
+            if len(self.object_cache) >= 4096:
+                self.object_cache.clear()
+            self.stats.count('cache_misses')
+            self.object_cache[key] = pygame.transform.rotate(pygame.transform.scale(spr_surf, size), rotation)
+        return self.object_cache[key]
+
+    def update_animations(self, ticks):
+        """ Computes the current frame of all the animations, once per tick. """
+        if ticks == self.anim_ticks:
+            return
+        self.anim_ticks = ticks
+        changed_lids = []
+        for key, anim in self.animations.items():
+            total_frames = anim['frame_count']# + 1
+            # 1 game cycle == 1/20th of a second
+            frame_idx = (ticks // (max(1, anim['speed']) * 1000 // 20)) % total_frames
+            if frame_idx == 0:
+                frame = (False, anim['block'])
+            else:
+                frame = (True, anim['frames'][frame_idx - 1])
+            if self.anim_frames.get(key) != frame:
+                self.anim_frames[key] = frame
+                if key[1] == 1:
+                    changed_lids.append(key[0])
+        if changed_lids and self.lod_surfaces:
+            self.update_lod_surfaces(changed_lids)
+
+    def get_animated_block(self, block_idx, which, ticks):
+        if ticks != self.anim_ticks:
+            self.update_animations(ticks)
+        return self.anim_frames.get((block_idx, which), (False, block_idx))
+
+    def get_tile_surface(self, type_name, idx, ticks=0, remap=0, animated=True):
+        if animated:
+            which = 1 if type_name == 'lid' else 0
+            aux, idx = self.get_animated_block(idx, which, ticks)
+            if aux:
+                type_name = 'aux'
         key = (type_name, idx, remap)
         if key in self.surface_cache: return self.surface_cache[key]
         if idx == 0: return None
+        self.stats.count('cache_misses')
         num_side = len(self.g24.side_blocks)
         num_lid = len(self.g24.lid_blocks)
         if self.g24.version == 336: # G24
@@ -530,25 +2000,79 @@ class MapRenderer:
                 clut_idx = 0
             else: return None
 
-        palette = self.g24.get_palette(clut_idx)
-        surf = pygame.Surface((64, 64), pygame.SRCALPHA)
-        for y in range(64):
-            for x in range(64):
-                surf.set_at((x, y), palette[pixels[y*64 + x]])
+        # pygame arrays are indexed by x first.
+        surf = self.indexed_surface(pixels.T, self.g24.get_palette(clut_idx))
         self.surface_cache[key] = surf
         return surf
 
+    def indexed_surface(self, pixels, palette):
+        """ Builds a surface from an (x, y) array of color indices and a (256, 4) palette. """
+        rgba = palette[pixels]
+        surf = pygame.Surface(pixels.shape, pygame.SRCALPHA)
+        pygame.surfarray.pixels3d(surf)[:] = rgba[:, :, :3]
+        pygame.surfarray.pixels_alpha(surf)[:] = rgba[:, :, 3]
+        return surf
+
     def get_sprite_surface(self, spr_num, remap):
         key = (spr_num, remap)
         if key in self.sprite_cache: return self.sprite_cache[key]
         if spr_num >= len(self.g24.sprite_info): return None
         info = self.g24.sprite_info[spr_num]
-        w, h = info['w'], info['h']
-        if w == 0 or h == 0: return None
+        if info['w'] == 0 or info['h'] == 0: return None
+        self.stats.count('cache_misses')
+        surf = self.indexed_surface(self.get_sprite_pixels(spr_num), self.get_sprite_palette(spr_num, remap))
+        self.sprite_cache[key] = surf
+        return surf
+
+    def get_composite_surface(self, spr_num, remap, deltas=(), rider=None):
+        """ Returns a sprite with some of its deltas applied (damages, opened doors, ...)
+        and another sprite drawn over it (e.g. the driver of a convertible).
+
+        deltas is a tuple of delta numbers and rider a (sprite number, x, y) tuple.
+        """
+        if not deltas and rider is None:
+            return self.get_sprite_surface(spr_num, remap)
+        key = (spr_num, remap, deltas, rider)
+        if key in self.composite_cache: return self.composite_cache[key]
+        if spr_num >= len(self.g24.sprite_info): return None
+        info = self.g24.sprite_info[spr_num]
+        if info['w'] == 0 or info['h'] == 0: return None
+        # Damages make a lot of combinations, don't keep them all forever.
+        if len(self.composite_cache) >= 1024:
+            self.composite_cache.clear()
+        self.stats.count('cache_misses')
+        pixels = self.get_sprite_pixels(spr_num)
+        for delta in deltas:
+            x, y, colors = self.g24.get_sprite_delta(spr_num, delta)
+            pixels[x, y] = colors
+        surf = self.indexed_surface(pixels, self.get_sprite_palette(spr_num, remap))
+        if rider is not None:
+            rider_num, rx, ry = rider
+            rider_surf = self.get_sprite_surface(rider_num, 0)
+            if rider_surf:
+                surf.blit(rider_surf, (rx, ry))
+        self.composite_cache[key] = surf
+        return surf
 
+    def get_sprite_pixels(self, spr_num):
+        """ Returns the color indices of a sprite as a new (x, y) array, like pygame arrays. """
+        info = self.g24.sprite_info[spr_num]
+        if self.g24.version == 336: # G24
+            pixel_start = info['page'] * 256 * 256 + info['yoff'] * 256 + info['xoff']
+        else: # GRY
+            pixel_start = info['ptr']
+        # Sprites are stored in 256 pixels wide pages.
+        stride = 256
+        graphics = np.frombuffer(self.g24.sprite_graphics, dtype=np.uint8)
+        offsets = pixel_start + np.arange(info['w'])[:, np.newaxis] + np.arange(info['h'])[np.newaxis, :] * stride
+        pixels = np.zeros((info['w'], info['h']), dtype=np.uint8)
+        inside = offsets < len(graphics)
+        pixels[inside] = graphics[offsets[inside]]
+        return pixels
+
+    def get_sprite_palette(self, spr_num, remap):
+        info = self.g24.sprite_info[spr_num]
         if self.g24.version == 336: # G24
-            page_size = 256 * 256
-            pixel_start = info['page'] * page_size + info['yoff'] * 256 + info['xoff']
             tile_clut_count = self.g24.header['tileclut_size'] // 1024
             sprite_clut_count = self.g24.header['spriteclut_size'] // 1024
 
@@ -561,23 +2085,32 @@ class MapRenderer:
                 clut_idx = 0
             else:
                 clut_idx = self.g24.pal_index[virtual_clut]
-            stride = 256
         else: # GRY
-            pixel_start = info['ptr']
             clut_idx = 0
             if remap > 0:
                 clut_idx = remap
-            stride = 256
-
-        palette = self.g24.get_palette(clut_idx)
-        surf = pygame.Surface((w, h), pygame.SRCALPHA)
-        for py in range(h):
-            row_start = pixel_start + py * stride
-            for px in range(w):
-                if row_start + px < len(self.g24.sprite_graphics):
-                    surf.set_at((px, py), palette[self.g24.sprite_graphics[row_start + px]])
-        self.sprite_cache[key] = surf
-        return surf
+        return self.g24.get_palette(clut_idx)
+
+    def project_corners(self, z, x0, y0, x1, y1):
+        """ Projects at once the corners of all the blocks of level z in [x0, x1) x [y0, y1).
+
+        Returns the lid corners (TL, TR, BR, BL) of each block, taking the slopes into
+        account, as a (y1-y0, x1-x0, 4, 2) array, and the screen x and y of the corners
+        of the grid at the top of the level (z+1), as arrays of x1-x0+1 and y1-y0+1 values.
+        Same computations as world_to_screen, so the results are exactly the same.
+        """
+        slopes = self.world.block_slopes[self.world.block_grid[z, y0:y1, x0:x1]]
+        h = 5 - (z + self.world.slope_corners[slopes])
+        scale = self.base_scale * (1.0 + h * self.scale_factor * self.base_scale)
+        xs = np.arange(x0, x1)[np.newaxis, :, np.newaxis] + np.array([0, 1, 1, 0])
+        ys = np.arange(y0, y1)[:, np.newaxis, np.newaxis] + np.array([0, 0, 1, 1])
+        lids = np.empty(slopes.shape + (4, 2))
+        lids[..., 0] = (xs - self.view_x - self.display_tiles_h // 2) * scale * self.base_tile_size + self.screen_width // 2
+        lids[..., 1] = (ys - self.view_y - self.display_tiles_v // 2) * scale * self.base_tile_size + self.screen_height // 2
+        top_scale = self.base_scale * (1.0 + (5 - (z + 1)) * self.scale_factor * self.base_scale)
+        top_x = (np.arange(x0, x1 + 1) - self.view_x - self.display_tiles_h // 2) * top_scale * self.base_tile_size + self.screen_width // 2
+        top_y = (np.arange(y0, y1 + 1) - self.view_y - self.display_tiles_v // 2) * top_scale * self.base_tile_size + self.screen_height // 2
+        return lids, top_x, top_y
 
     def world_to_screen(self, x, y, z):
         h = 5 - z
@@ -595,6 +2128,7 @@ class MapRenderer:
 
     # Slow version
     def draw_textured_side_slow(self, surf, p1, p2, p3, p4):
+        from pygame import gfxdraw
         if not surf: return
         # We want to map the 64x64 texture onto a trapezoid p1, p2, p3, p4.
         # We apply the transformation:
@@ -733,9 +2267,192 @@ class MapRenderer:
             return
         out, warp_bounding_box = self.warp(surf, [(p1[0], p1[1]), (p2[0], p2[1]), (p3[0], p3[1]), (p4[0], p4[1])])
         if out is not None:
+            self.stats.count('faces')
+            self.stats.count('blits')
             self.screen.blit(out, (warp_bounding_box.x, warp_bounding_box.y))
 
-    def get_area_name(self, x, y):
+    def use_lod(self):
+        return self.base_scale * self.base_tile_size < self.lod_threshold
+
+    def get_lid_color(self, lid, remap, animated=False):
+        """ Returns the mean color of a lid, or of the current frame of its animation if animated. """
+        type_name = 'lid'
+        if animated:
+            aux, lid = self.anim_frames.get((lid, 1), (False, lid))
+            if aux:
+                type_name = 'aux'
+        key = (type_name, lid, remap)
+        if key not in self.lid_colors:
+            color = (0, 0, 0)
+            surf = self.get_tile_surface(type_name, lid, remap=remap, animated=False)
+            if surf:
+                rgb = pygame.surfarray.pixels3d(surf).reshape(-1, 3)
+                alpha = pygame.surfarray.pixels_alpha(surf).reshape(-1)
+                if alpha.any():
+                    color = tuple(int(c) for c in np.average(rgb, axis=0, weights=alpha))
+            self.lid_colors[key] = color
+        return self.lid_colors[key]
+
+    def build_lod_surface(self, levels, apply_remaps):
+        """ Returns a 256x256 surface with the mean color of the highest lid of each column within levels.
+
+        Also returns the lid * 4 + remap of each column, to recolor the animated lids when their frame changes.
+        """
+        lids = np.zeros((256, 256), dtype=np.int32)
+        remaps = np.zeros((256, 256), dtype=np.int32)
+        for z in sorted(levels):
+            grid = self.world.block_grid[z]
+            has_lid = (grid >= 0) & (lids == 0)
+            has_lid[has_lid] = self.world.block_lids[grid[has_lid]] > 0
+            lids[has_lid] = self.world.block_lids[grid[has_lid]]
+            remaps[has_lid] = self.world.block_lid_remaps[grid[has_lid]]
+        if not apply_remaps:
+            remaps[:] = 0
+        lid_keys = lids * 4 + remaps
+        keys, inverse = np.unique(lid_keys, return_inverse=True)
+        palette = np.array([self.get_lid_color(key // 4, key % 4, animated=True) if key >= 4 else (0, 0, 0) for key in keys.tolist()], dtype=np.uint8)
+        colors = palette[inverse.reshape(256, 256)]
+        return pygame.surfarray.make_surface(colors.swapaxes(0, 1)), lid_keys
+
+    def get_lod_surface(self, levels, apply_remaps):
+        key = (tuple(sorted(levels)), apply_remaps)
+        if key not in self.lod_surfaces:
+            self.stats.count('cache_misses')
+            self.lod_surfaces[key] = self.build_lod_surface(levels, apply_remaps)
+        return self.lod_surfaces[key][0]
+
+    def update_lod_surfaces(self, lids):
+        """ Recolors only the columns of the zoomed out maps whose lid is one of the animated lids that changed frame. """
+        for key, (surf, lid_keys) in self.lod_surfaces.items():
+            columns = np.isin(lid_keys // 4, lids)
+            if not columns.any():
+                continue
+            keys, inverse = np.unique(lid_keys[columns], return_inverse=True)
+            palette = np.array([self.get_lid_color(lid_key // 4, lid_key % 4, animated=True) for lid_key in keys.tolist()], dtype=np.uint8)
+            # pygame arrays are indexed by x first.
+            pixels = pygame.surfarray.pixels3d(surf)
+            pixels.swapaxes(0, 1)[columns] = palette[inverse]
+            del pixels
+            if key == (tuple(range(6)), True):
+                self.minimap = None
+
+    def draw_lod(self, levels):
+        """ Draws the map with one color per column, for when textures would be only a few pixels wide. """
+        self.stats.start('lids')
+        lod_surface = self.get_lod_surface(levels, self.apply_remaps)
+        min_x, min_y = self.screen_to_world(0, 0, 5)
+        max_x, max_y = self.screen_to_world(self.screen_width, self.screen_height, 5)
+        x0, y0 = max(int(min_x), 0), max(int(min_y), 0)
+        x1, y1 = min(int(max_x) + 1, 256), min(int(max_y) + 1, 256)
+        if x0 < x1 and y0 < y1:
+            sx0, sy0, _ = self.world_to_screen(x0, y0, 5)
+            sx1, sy1, _ = self.world_to_screen(x1, y1, 5)
+            colors = lod_surface.subsurface((x0, y0, x1 - x0, y1 - y0))
+            self.stats.count('blits')
+            self.screen.blit(pygame.transform.scale(colors, (int(sx1) - int(sx0), int(sy1) - int(sy0))), (int(sx0), int(sy0)))
+        self.stats.stop('lids')
+
+    def draw_sides(self, faces):
+        """ Draws a list of (surface, flip, quad) side faces in order. """
+        if self.render_pool is None:
+            for surf, flip, quad in faces:
+                if surf:
+                    self.draw_textured_side(pygame.transform.flip(surf, flip, 0), *quad)
+            return
+        prepared = [face for face in map(self.prepare_face, faces) if face is not None]
+        if not prepared:
+            return
+        self.stats.count('faces', len(prepared))
+        self.stats.count('blits', len(prepared))
+        # Each thread rasterizes all the faces overlapping its own band of the screen, in
+        # order, directly in the screen pixels. cv2 and numpy release the GIL while working.
+        screen_px = pygame.surfarray.pixels3d(self.screen)
+        bands = np.linspace(0, self.screen_height, 2 * self.render_threads + 1).astype(int)
+        list(self.render_pool.map(lambda y: self.rasterize_band(screen_px, prepared, y[0], y[1]), zip(bands[:-1], bands[1:])))
+        del screen_px
+
+    def prepare_face(self, face):
+        """ Computes what the rasterizer needs to draw a side face (see warp), or None if it isn't visible. """
+        surf, flip, quad = face
+        if not surf:
+            return None
+        xs, ys = [p[0] for p in quad], [p[1] for p in quad]
+        if max(xs) < 0 or max(ys) < 0 or min(xs) > self.screen_width or min(ys) > self.screen_height:
+            return None
+        min_x, min_y = min(xs), min(ys)
+        w, h = int(max(xs) - min_x), int(max(ys) - min_y)
+        if int(min_x) == int(max(xs)) or int(min_y) == int(max(ys)):
+            return None
+        key = (surf, flip)
+        if key not in self.face_arrays:
+            flipped = pygame.transform.flip(surf, flip, 0)
+            self.face_arrays[key] = (pygame.surfarray.array3d(flipped), pygame.surfarray.array_alpha(flipped))
+        rgb, alpha = self.face_arrays[key]
+        # Same as warp: cv2 sees pygame arrays transposed, so x and y are swapped.
+        sw, sh = rgb.shape[0:2]
+        src_corners = np.float32([(0, 0), (0, sw), (sh, sw), (sh, 0)])
+        dst_corners = np.float32([(p[1] - min_y, p[0] - min_x) for p in quad])
+        mat = cv2.getPerspectiveTransform(src_corners, dst_corners)
+        return rgb, alpha, mat, int(min_x), int(min_y), w, h
+
+    def rasterize_band(self, screen_px, faces, y0, y1):
+        """ Warps and blends the faces in the rows [y0, y1) of the screen pixels. """
+        for rgb, alpha, mat, fx, fy, w, h in faces:
+            x_start, x_end = max(fx, 0), min(fx + w, self.screen_width)
+            y_start, y_end = max(fy, y0), min(fy + h, y1)
+            if x_start >= x_end or y_start >= y_end:
+                continue
+            # Only compute the part of the face that is in the band.
+            shift = np.array([[1, 0, fy - y_start], [0, 1, fx - x_start], [0, 0, 1]], dtype=np.float64)
+            m = shift @ mat
+            size = (y_end - y_start, x_end - x_start)
+            src = cv2.warpPerspective(rgb, m, size, flags=cv2.INTER_LINEAR).astype(np.int32)
+            a = cv2.warpPerspective(alpha, m, size, flags=cv2.INTER_LINEAR).astype(np.int32)[:, :, np.newaxis]
+            dst = screen_px[x_start:x_end, y_start:y_end]
+            d = dst.astype(np.int32)
+            # Same blending as pygame's blit of a per-pixel alpha surface.
+            dst[:] = d + (((src - d) * a + src) >> 8)
+
+    def render_text(self, text, color=(255, 255, 255), font=None):
+        font = font or self.font
+        key = (text, color, font)
+        if key not in self.text_cache:
+            # Some texts change all the time (e.g. position), don't keep all of them.
+            if len(self.text_cache) >= 256:
+                self.text_cache.clear()
+            self.text_cache[key] = font.render(text, True, color)
+        return self.text_cache[key]
+
+    def get_background(self, width, height, alpha):
+        key = (width, height, alpha)
+        if key not in self.background_cache:
+            if len(self.background_cache) >= 64:
+                self.background_cache.clear()
+            bg = pygame.Surface((width, height))
+            bg.fill((0, 0, 0))
+            bg.set_alpha(alpha)
+            self.background_cache[key] = bg
+        return self.background_cache[key]
+
+    def draw_minimap(self, x, y):
+        """ Draws an overview of the city with the part currently displayed and the current area. """
+        if self.minimap is None:
+            # Same colors as the zoomed out map, built again when one of its animated lids changes.
+            self.minimap = pygame.transform.smoothscale(self.get_lod_surface(range(6), True), (MINIMAP_SIZE, MINIMAP_SIZE))
+        ratio = MINIMAP_SIZE / 256
+        self.screen.blit(self.minimap, (x, y))
+        area = self.get_area(int(self.view_x + 10), int(self.view_y + 8))
+        if area:
+            pygame.draw.rect(self.screen, (255, 255, 0), (x + area['x'] * ratio, y + area['y'] * ratio, area['w'] * ratio, area['h'] * ratio), 1)
+            img = self.render_text(area['name'], (255, 255, 0), self.small_font)
+            self.screen.blit(self.get_background(img.get_width() + 4, img.get_height(), 180), (x, y))
+            self.screen.blit(img, (x + 2, y))
+        min_x, min_y = self.screen_to_world(0, 0, 5)
+        max_x, max_y = self.screen_to_world(self.screen_width, self.screen_height, 5)
+        view = pygame.Rect(x + min_x * ratio, y + min_y * ratio, (max_x - min_x) * ratio, (max_y - min_y) * ratio)
+        pygame.draw.rect(self.screen, (255, 255, 255), view.clip((x, y, MINIMAP_SIZE, MINIMAP_SIZE)), 1)
+
+    def get_area(self, x, y):
         best_area = None
         best_size = 256 * 256 + 1
         for area in self.cmp.nav_data:
@@ -744,7 +2461,11 @@ class MapRenderer:
                 if size < best_size:
                     best_size = size
                     best_area = area
-        return best_area['name'] if best_area else ""
+        return best_area
+
+    def get_area_name(self, x, y):
+        area = self.get_area(x, y)
+        return area['name'] if area else ""
 
     def get_slope_heights(self, z, slope_type):
         """ Returns slope heights for the 4 corners of a lid: top-left, top-right, bottom-right, bottom-left. """
@@ -776,6 +2497,236 @@ class MapRenderer:
         return "car"
 
 
+    def draw_layer(self, z, ticks):
+        """ Draws the tiles and objects of level z on self.screen. """
+        # Margin to handle parallax bringing blocks from sides
+        margin = 1
+        min_x, min_y = self.screen_to_world(0, 0, z)
+        max_x, max_y = self.screen_to_world(self.screen_width, self.screen_height, z)
+        min_x, min_y = int(min_x-margin), int(min_y-margin)
+        max_x, max_y = int(max_x+margin+1), int(max_y+margin+1)
+        x0, y0, x1, y1 = max(min_x, 0), max(min_y, 0), min(max_x, 256), min(max_y, 256)
+        if self.show_tiles and 0 <= z < 6 and x0 < x1 and y0 < y1:
+            grid = self.world.block_grid[z, y0:y1, x0:x1]
+            cells = np.nonzero(grid >= 0)
+            lids, top_x, top_y = self.project_corners(z, x0, y0, x1, y1)
+            lids, top_x, top_y = lids[cells].tolist(), top_x.tolist(), top_y.tolist()
+            cells = list(zip(cells[0].tolist(), cells[1].tolist(), grid[cells].tolist(), lids))
+            for step in ['sides', 'lid']:
+                phase = 'sides' if step == 'sides' else 'lids'
+                self.stats.start(phase)
+                faces = []
+                for j, i, blk_idx, corners in cells:
+                    block = self.world.blocks[blk_idx]
+                    c1, c2, c3, c4 = corners
+                    if step == 'sides' and self.show_sides and z < 5:
+                        b1, b2, b3, b4 = (top_x[i], top_y[j]), (top_x[i+1], top_y[j]), (top_x[i+1], top_y[j+1]), (top_x[i], top_y[j+1])
+                        if block['top'] > 0:
+                            faces.append((self.get_tile_surface('side', block['top'], ticks), block['flip_top_bottom'], (c1, c2, b2, b1)))
+                        if block['bottom'] > 0 and not block['flat']:
+                            faces.append((self.get_tile_surface('side', block['bottom'], ticks), block['flip_top_bottom'], (c4, c3, b3, b4)))
+                        if block['left'] > 0:
+                            faces.append((self.get_tile_surface('side', block['left'], ticks), block['flip_left_right'], (c1, c4, b4, b1)))
+                        if block['right'] > 0 and not block['flat']:
+                            faces.append((self.get_tile_surface('side', block['right'], ticks), block['flip_left_right'], (c2, c3, b3, b2)))
+                    if step == 'lid' and self.show_lids:
+                        if block['lid'] > 0:
+                            lid_remap = block['lid_remap']
+                            if not self.apply_remaps:
+                                lid_remap = 0
+                            surf = self.get_tile_surface('lid', block['lid'], ticks, lid_remap)
+                            if surf:
+                                if block['lid_rotation'] != 0: surf = pygame.transform.rotate(surf, -90 * block['lid_rotation'])
+                                w, h = int(c2[0]-c1[0])+1, int(c4[1]-c1[1])+1
+                                if block['slope'] != 0:
+                                    # I'm not sure why this is needed, but without the 'spill', there's a black border around some of the blocks with slopes.
+                                    # This doesn't fully fix the issue but this is the best result I managed so far.
+                                    spill = 2*self.base_scale
+                                    c1 = int(c1[0]), int(c1[1])
+                                    c2 = int(c2[0]+spill), int(c2[1])
+                                    c3 = int(c3[0]+spill), int(c3[1]+spill)
+                                    c4 = int(c4[0]), int(c4[1]+spill)
+                                    self.draw_textured_side(surf, c1, c2, c3, c4)
+                                else:
+                                    if w > 0 and h > 0:
+                                        self.stats.count('blits')
+                                        self.screen.blit(pygame.transform.scale(surf, (w, h)), (int(c1[0]), int(c1[1])))
+                                    else:
+                                        print(f"WARNING: Unexpected width & height for lid: {w},{h}")
+                self.draw_sides(faces)
+                self.stats.stop(phase)
+        if self.show_objects:
+            self.stats.start('objects')
+            if self.level_objects is None:
+                self.index_objects()
+            for ox, oy, oz, spr_num, frames, duration, rotation in self.level_objects.get(z, ()):
+                if min_x < ox < max_x and min_y < oy < max_y:
+                    if frames > 1:
+                        spr_num += (ticks // duration) % frames
+                    sx, sy, scale = self.world_to_screen(ox, oy, oz)
+                    rotated = self.get_object_surface(spr_num, scale, rotation)
+                    if rotated:
+                        self.stats.count('blits')
+                        self.screen.blit(rotated, (int(sx - rotated.get_width()/2), int(sy - rotated.get_height()/2)))
+            self.draw_traffic_lights(z, min_x, min_y, max_x, max_y)
+            if self.world.crowd is not None:
+                self.draw_crowd(z, min_x, min_y, max_x, max_y)
+            if self.world.traffic is not None:
+                self.draw_traffic(z, min_x, min_y, max_x, max_y)
+            self.stats.stop('objects')
+
+    def draw_traffic_lights(self, z, min_x, min_y, max_x, max_y):
+        """ Draws the traffic lights of level z, in the middle of their block and not in perspective. """
+        base = self.g24.sprite_bases.get('traffic_lights')
+        if base is None:
+            return
+        visible = np.nonzero((self.world.light_levels == z) & (self.world.light_x >= min_x) & (self.world.light_x < max_x) &
+                             (self.world.light_y >= min_y) & (self.world.light_y < max_y))[0]
+        if len(visible) == 0:
+            return
+        sx, sy, scale = self.world_to_screen(self.world.light_x[visible] + 0.5, self.world.light_y[visible] + 0.5, z)
+        sprites = base + self.world.light_states[visible]
+        for sx, sy, spr_num, rotation in zip(sx.tolist(), sy.tolist(), sprites.tolist(), self.world.light_rotations[visible].tolist()):
+            rotated = self.get_object_surface(spr_num, scale, rotation)
+            if rotated:
+                self.stats.count('blits')
+                self.screen.blit(rotated, (int(sx - rotated.get_width()/2), int(sy - rotated.get_height()/2)))
+
+    def draw_crowd(self, z, min_x, min_y, max_x, max_y):
+        """ Draws the pedestrians of the crowd at level z, walking on the pavements of level z + 1 like the player. """
+        crowd = self.world.crowd
+        visible = np.nonzero((np.maximum(crowd.z - 1, 0) == z) & (crowd.x >= min_x) & (crowd.x < max_x) & (crowd.y >= min_y) & (crowd.y < max_y))[0]
+        if len(visible) == 0:
+            return
+        sx, sy, scale = self.world_to_screen(crowd.x[visible], crowd.y[visible], z)
+        # The walking animation are the first sprites of the pedestrians.
+        sprites = self.g24.sprite_bases['ped'] + crowd.frame[visible]
+        # Rotations are rounded, so that the rotated sprites can be cached.
+        rotations = (np.round(crowd.rotation[visible] / 15) * 15 % 360).astype(np.int32)
+        for sx, sy, spr_num, rotation, remap in zip(sx.tolist(), sy.tolist(), sprites.tolist(), rotations.tolist(), crowd.remap[visible].tolist()):
+            rotated = self.get_object_surface(spr_num, scale, rotation, self.pedestrian_remap(remap))
+            if rotated:
+                self.stats.count('blits')
+                self.screen.blit(rotated, (int(sx - rotated.get_width()/2), int(sy - rotated.get_height()/2)))
+
+    def draw_traffic(self, z, min_x, min_y, max_x, max_y):
+        """ Draws the cars of the traffic at level z, driving on the roads of level z + 1 like the player. """
+        traffic = self.world.traffic
+        x, y = traffic.positions(self.sim_alpha)
+        visible = np.nonzero((np.maximum(traffic.level[traffic.node] - 1, 0) == z) & (x >= min_x) & (x < max_x) & (y >= min_y) & (y < max_y))[0]
+        if len(visible) == 0:
+            return
+        sx, sy, scale = self.world_to_screen(x[visible], y[visible], z)
+        cars = traffic.car[visible]
+        # There are 12 remaps per car.
+        remaps = np.where(traffic.remap[visible] > 0, cars * 12 + traffic.remap[visible] - 1, -1)
+        rotations = traffic.rotations[traffic.dir[visible]]
+        for sx, sy, spr_num, rotation, remap in zip(sx.tolist(), sy.tolist(), self.car_sprites[cars].tolist(), rotations.tolist(), remaps.tolist()):
+            rotated = self.get_object_surface(spr_num, scale, rotation, remap)
+            if rotated:
+                self.stats.count('blits')
+                self.screen.blit(rotated, (int(sx - rotated.get_width()/2), int(sy - rotated.get_height()/2)))
+
+    def pedestrian_remap(self, remap):
+        """ Returns the sprite remap of pedestrian remap number remap (1 to 64), -1 for none (0). """
+        if remap == 0:
+            return -1
+        if 'newcarclut_size' in self.g24.header:
+            base_remap = self.g24.header['newcarclut_size'] // 1024 - 64  # There are 64 remaps for pedestrian and they are at the end of the newcarclut section
+        else:
+            base_remap = 125
+        return base_remap + remap - 1
+
+    def render_view(self, x, y, zoom, layers=None, size=None, ticks=0):
+        """ Renders the map offscreen and returns it as a (height, width, 3) RGB array.
+
+        (x, y) is the world position (in blocks) displayed at the center of the
+        image at ground level, zoom is the base scale (as with u/d in the viewer)
+        and layers is the list of levels to draw (defaults to min_z..max_z).
+        Caches are shared with the interactive view, and the view state is
+        restored afterwards, so this can be called from scripts or in between
+        frames of the viewer. ticks is the time of the animations, the traffic
+        lights are the ones of the current game cycle of the world.
+        """
+        if layers is None:
+            layers = range(self.min_z, self.max_z)
+        if size is None:
+            size = (self.screen_width, self.screen_height)
+        saved = (self.screen, self.screen_width, self.screen_height, self.view_x, self.view_y, self.base_scale)
+        try:
+            if self.offscreen is None or self.offscreen.get_size() != tuple(size):
+                self.offscreen = pygame.Surface(size)
+            self.screen = self.offscreen
+            self.set_view_size(*size)
+            self.view_x = x - self.display_tiles_h // 2
+            self.view_y = y - self.display_tiles_v // 2
+            self.base_scale = zoom
+            self.update_animations(ticks)
+            self.screen.fill((0, 0, 0))
+            if self.use_lod():
+                self.draw_lod(layers)
+            else:
+                for z in sorted(layers, reverse=True):
+                    self.draw_layer(z, ticks)
+            return np.ascontiguousarray(pygame.surfarray.array3d(self.screen).swapaxes(0, 1))
+        finally:
+            self.screen, width, height, self.view_x, self.view_y, self.base_scale = saved
+            self.set_view_size(width, height)
+
+    def sim_state(self):
+        return self.view_x, self.view_y, self.world.player_rotation
+
+    def set_sim_state(self, state):
+        self.view_x, self.view_y, self.world.player_rotation = state
+
+    def interpolate_sim_state(self, previous, current, alpha):
+        (x0, y0, r0), (x1, y1, r1) = previous, current
+        # The rotation wraps around, take the shortest way.
+        dr = (r1 - r0 + 180) % 360 - 180
+        return x0 + (x1 - x0) * alpha, y0 + (y1 - y0) * alpha, r1 - dr * (1 - alpha)
+
+    def step(self, keys):
+        """ Advances the simulation by one game cycle (SIM_TICK_MS) in display mode, given the pressed keys.
+
+        The view moves with the keys, and the player with it, the rest of the world goes on.
+        """
+        vrotate = 15 # rotation speed
+        move_speed = 3
+        if keys[pygame.K_LEFT]: self.view_x -= move_speed
+        if keys[pygame.K_RIGHT]: self.view_x += move_speed
+        if keys[pygame.K_UP]: self.view_y -= move_speed
+        if keys[pygame.K_DOWN]: self.view_y += move_speed
+        if keys[pygame.K_x]: self.world.player_rotation += vrotate
+        if keys[pygame.K_c]: self.world.player_rotation -= vrotate
+        if self.world.player_rotation > 360:
+            self.world.player_rotation -= 360
+        if self.world.player_rotation < -360:
+            self.world.player_rotation += 360
+        self.world.player_x, self.world.player_y = self.view_x + 10, self.view_y + 8
+        self.world.step_agents()
+
+    def step_inputs(self, inputs):
+        """ Advances play mode by one game cycle given its inputs (see InputRecorder), recording them if asked. """
+        if self.input_recorder:
+            self.input_recorder.record(self.play_cycle, inputs)
+        self.world.step(inputs)
+        # The view follows the player.
+        self.view_x, self.view_y = self.world.player_x - 10, self.world.player_y - 8
+        self.play_cycle += 1
+
+    def replay(self):
+        """ Plays back all the recorded inputs without rendering anything, as fast as possible. """
+        while self.play_cycle < self.input_player.end:
+            self.step_inputs(self.input_player.get(self.play_cycle))
+        self.end_replay()
+        if self.input_recorder:
+            self.input_recorder.close()
+
+    def end_replay(self):
+        # The final state, to compare runs of the same inputs.
+        print(f"Replay ended after {self.play_cycle} game cycles: player at ({self.world.player_x:.6f}, {self.world.player_y:.6f}, {self.world.player_height}), rotation {self.world.player_rotation:.6f}")
+        self.input_player = None
+
     def run(self):
         ped_legends = [
             "Walking", "Running", "Exiting vehicle", "Entering vehicle", "???", "Tumble", "Down", "???", "???", "???", "Punching (still)", "???",
@@ -798,17 +2749,13 @@ class MapRenderer:
             1, 1, 5, 2
         ]
         ped_boundaries = [sum(ped_grouping[:x]) for x in range(len(ped_grouping))]
-        player_sprite = 0
-        player_height = 4
-        player_rotation = 0
-        player_weapon = 0  # 0=fist, 1=pistol, 2=machine gun, 3=rocket launcher, 4=flamethrower, 5=petrol bomb
-        vrotate = 5 # rotation speed
-        player_remap = 0
         anim_tick_start = pygame.time.get_ticks()
-        car_speed = 0
         help_text = ["Commands:",
                      " F1: Show this help message",
                      " F2: Switch between display mode and play mode",
+                     " F3: Show frame timings graph",
+                     " F4: Show minimap",
+                     " F5: Pause/resume recording (with --record)",
                      " i: Show information window",
                      " q/Escape: Quit",
                      " f: toggle fullscreen",
@@ -821,6 +2768,7 @@ class MapRenderer:
                      " n: switch to next player sprite",
                      " h/H: move player up/down",
                      " m/M: switch to next/previous player remap",
+                     " e/E: switch to next/previous combination of deltas (damages, doors, ...) of the car",
                      " u/d: move camera up/down (a.k.a. dezoom/zoom)",
                      " r: toggle apply remaps",
                      "",
@@ -828,6 +2776,7 @@ class MapRenderer:
                      " up: move forward/accelerate",
                      " down: move backward/decelarate",
                      " left/right: turn left(counter clockwise)/right(clockwise)",
+                     " space: handbrake",
                      " c: switch between car/pedestrian",
                      " n/p: switch to next/previous car",
                      ]
@@ -835,11 +2784,18 @@ class MapRenderer:
         running = True
         show_info = True
         show_help = False
-        # 0 = no, 1 = pedestrian, 2 = car
-        show_player = 0
+        show_timings = False
+        show_minimap = True
         start = None
         frames = 0
         fps = 0.0
+        last_check = 0
+        # The simulation runs at a fixed rate and is decoupled from the rendering.
+        sim_time = pygame.time.get_ticks()
+        previous = self.sim_state()
+        # Keys of play mode pressed since the last game cycle, as bits of its inputs.
+        action_bits = {getattr(pygame, name): 1 << (INPUT_ACTIONS_SHIFT + bit) for bit, name in enumerate(INPUT_ACTIONS)}
+        actions = 0
         while running:
             ticks = pygame.time.get_ticks()
             if start is None:
@@ -850,6 +2806,10 @@ class MapRenderer:
                 fps = 1000*frames/(end-start)
                 start = None
             frames += 1
+            self.stats.start('events')
+            if ticks - last_check > 500:
+                last_check = ticks
+                self.check_files()
             for event in pygame.event.get():
                 if event.type == pygame.QUIT: running = False
                 if event.type == pygame.MOUSEBUTTONDOWN:
@@ -864,55 +2824,66 @@ class MapRenderer:
                     if event.key == pygame.K_F2:
                         self.play_mode = not self.play_mode
                         if self.play_mode:
-                            show_player = 1
+                            self.world.show_player = 1
+                        else:
+                            # The recorded inputs only make sense from the start of play mode.
+                            if self.input_recorder:
+                                self.input_recorder.close()
+                            self.input_player = None
+                    if event.key == pygame.K_F3:
+                        show_timings = not show_timings
+                    if event.key == pygame.K_F4:
+                        show_minimap = not show_minimap
+                    if event.key == pygame.K_F5 and self.recorder:
+                        self.recorder.paused = not self.recorder.paused
                     if event.key == pygame.K_i: show_info = not show_info
                     if event.key == pygame.K_ESCAPE or event.key == pygame.K_q: running = False
                     if event.key == pygame.K_f:
                         self.fullscreen = not self.fullscreen
                         self.init_display()
                     if self.play_mode:
-                        if event.key == pygame.K_c:
-                            show_player = 2 if show_player == 1 else 1
-                        if event.key == pygame.K_n:
-                            # Switch to the next car model
-                            if show_player == 2 and player_sprite + 1 < len(self.g24.car_info):
-                                player_sprite += 1
-                        if event.key == pygame.K_p:
-                            # Switch to previous car model
-                            if show_player == 2 and player_sprite > 0:
-                                player_sprite -= 1
-                        if event.key == pygame.K_w:
-                            player_weapon = (player_weapon + 1) % 6
-                        if event.key == pygame.K_x:
-                            player_weapon = (player_weapon - 1) % 6
+                        # Applied with the next game cycle, so that they can be recorded and played back.
+                        if event.key in action_bits and self.input_player is None:
+                            actions |= action_bits[event.key]
                     else:
                         if event.key == pygame.K_s:
-                            show_player = (show_player + 1) % 3
-                            player_sprite = 0
-                            player_remap = 0
+                            self.world.show_player = (self.world.show_player + 1) % 3
+                            self.world.player_sprite = 0
+                            self.world.player_remap = 0
+                            self.world.player_deltas = 0
                             anim_tick_start = pygame.time.get_ticks()
                         if event.key == pygame.K_p:
-                            if player_sprite > 0:
-                                player_sprite -= 1
+                            if self.world.player_sprite > 0:
+                                self.world.player_sprite -= 1
+                            self.world.player_deltas = 0
                             anim_tick_start = ticks
                         if event.key == pygame.K_n:
-                            if (show_player == 1 and player_sprite + 1 < len(ped_grouping)) or (show_player == 2 and player_sprite + 1 < len(self.g24.car_info)):
-                                player_sprite += 1
+                            if (self.world.show_player == 1 and self.world.player_sprite + 1 < len(ped_grouping)) or (self.world.show_player == 2 and self.world.player_sprite + 1 < len(self.g24.car_info)):
+                                self.world.player_sprite += 1
+                            self.world.player_deltas = 0
                             anim_tick_start = ticks
+                        if event.key == pygame.K_e and self.world.show_player == 2:
+                            car_info = self.g24.car_info[self.world.player_sprite]
+                            spr_num = car_info['spr_num'] + self.g24.sprite_bases[self.vehicle_type_const(car_info['vtype'])]
+                            combinations = 1 << self.g24.sprite_info[spr_num]['dc']
+                            if event.mod & pygame.KMOD_SHIFT:
+                                self.world.player_deltas = (self.world.player_deltas - 1) % combinations
+                            else:
+                                self.world.player_deltas = (self.world.player_deltas + 1) % combinations
                         if event.key == pygame.K_h:
                             if event.mod & pygame.KMOD_SHIFT:
-                                if player_height < 5:
-                                    player_height += 1
+                                if self.world.player_height < 5:
+                                    self.world.player_height += 1
                             else:
-                                if player_height > 0:
-                                    player_height -= 1
+                                if self.world.player_height > 0:
+                                    self.world.player_height -= 1
                         if event.key == pygame.K_m:
                             if event.mod & pygame.KMOD_SHIFT:
-                                if player_remap > 0:
-                                    player_remap -= 1
+                                if self.world.player_remap > 0:
+                                    self.world.player_remap -= 1
                             else:
-                                if (show_player == 1 and player_remap < 64) or (show_player == 2 and player_remap < 12):
-                                    player_remap += 1
+                                if (self.world.show_player == 1 and self.world.player_remap < 64) or (self.world.show_player == 2 and self.world.player_remap < 12):
+                                    self.world.player_remap += 1
                         if event.key == pygame.K_u:
                             # 0.05 is roughly where we start to see the whole map on the screen (at 1024x768)
                             # This is already very slow, no need to let the user go further.
@@ -925,283 +2896,96 @@ class MapRenderer:
                         if event.key == pygame.K_r:
                             self.apply_remaps = not self.apply_remaps
             keys = pygame.key.get_pressed()
-            if self.play_mode:
-                walk_speed = 0.01
-                run_speed = 0.03
-                if show_player == 1:
-                    player_sprite = 21  # standing still
-                    if keys[pygame.K_LEFT]:
-                        player_rotation += vrotate
-                    if keys[pygame.K_RIGHT]:
-                        player_rotation -= vrotate
-                    if keys[pygame.K_UP]:
-                        player_sprite = 1  # running
-                        angle = 2*math.pi*player_rotation/360
-                        dx, dy = run_speed * math.sin(angle), run_speed * math.cos(angle)
-                        self.view_x += dx
-                        self.view_y += dy
-                    if keys[pygame.K_DOWN]:
-                        player_sprite = 0  # walking
-                        angle = 2*math.pi*player_rotation/360
-                        dx, dy = walk_speed * math.sin(angle), walk_speed * math.cos(angle)
-                        self.view_x -= dx
-                        self.view_y -= dy
-                    if keys[pygame.K_LCTRL]:
-                        # 10: Punching still
-                        # 18: Pistol still
-                        # 22: Pistol backward
-                        # 23: Pistol forward
-                        # 25: Flame-thrower backward
-                        # 26: Flame-thrower forward
-                        # 27: Flame-thrower still
-                        # 28: Machine-gun backward
-                        # 29: Machine-gun forward
-                        # 30: Machine-gun still
-                        # 31: Rocket launcher backward
-                        # 32: Rocket launcher forward
-                        # 33: Rocket launcher still
-                        # 36: Punching forward
-                        if player_weapon == 0: # Punching
-                            if player_sprite == 21:
-                                player_sprite = 10  # Punching still
-                            elif player_sprite == 1:
-                                player_sprite = 36  # Punching forward
-                            # No punching backward
-                        elif player_weapon == 1: # Pistol
-                            if player_sprite == 21:
-                                player_sprite = 18  # Pistol still
-                            elif player_sprite == 1:
-                                player_sprite = 23  # Pistol forward
-                            elif player_sprite == 0:
-                                player_sprite = 22  # Pistol backward
-                        elif player_weapon == 2: # Machine gun
-                            if player_sprite == 21:
-                                player_sprite = 30  # Machine gun still
-                            elif player_sprite == 1:
-                                player_sprite = 29  # Machine gun forward
-                            elif player_sprite == 0:
-                                player_sprite = 28  # Machine gun backward
-                        elif player_weapon == 3: # Rocket launcher
-                            if player_sprite == 21:
-                                player_sprite = 33  # Rocket launcher still
-                            elif player_sprite == 1:
-                                player_sprite = 32  # Rocket launcher forward
-                            elif player_sprite == 0:
-                                player_sprite = 31  # Rocket launcher backward
-                        elif player_weapon == 4: # Flame-thrower
-                            if player_sprite == 21:
-                                player_sprite = 27  # Flame-thrower still
-                            elif player_sprite == 1:
-                                player_sprite = 26  # Flame-thrower forward
-                            elif player_sprite == 0:
-                                player_sprite = 25  # Flame-thrower backward
-                        elif player_weapon == 5: # Petrol bomb: no sprites!
-                            pass
-                elif show_player == 2:
-                    car_info = self.g24.car_info[player_sprite]
-                    min_speed = -0.2
-                    max_speed = 0.5
-                    acceleration = 0.03
-                    braking = 0.001
-                    #min_speed = car_info['min_speed']
-                    #max_speed = car_info['max_speed']
-                    #braking = car_info['braking']
-                    #acceleration = car_info['acceleration']
-                    # TODO: Handle commands for driving car
-                    # TODO: Support handbrake
-                    # Natural braking of the car.
-                    if car_speed > 0:
-                        car_speed = max(min(car_speed-0.001, car_speed*0.95), 0)
-                    elif car_speed < 0:
-                        car_speed = min(max(car_speed+0.001, car_speed*0.95), 0)
-                    if keys[pygame.K_LEFT]:
-                        player_rotation += vrotate * car_speed * 3
-                    if keys[pygame.K_RIGHT]:
-                        player_rotation -= vrotate * car_speed * 3
-                    if keys[pygame.K_UP]:
-                        # TODO: Cap the car speed, use car's properties for acceleration, max speed, etc...
-                        if car_speed < max_speed:
-                            car_speed += 0.03
-                    if keys[pygame.K_DOWN]:
-                        if car_speed > min_speed:
-                            car_speed -= 0.02
-                    angle = 2*math.pi*player_rotation/360
-                    dx, dy = car_speed * math.sin(angle), car_speed * math.cos(angle)
-                    self.view_x += dx
-                    self.view_y += dy
-                # TODO: Zoom/dezoom depending on the speed
-                # TODO: React based on the tile: slow down on fields, crash on buildings, go up/down on slopes, ...
-            else:
-                move_speed = 1
-                if keys[pygame.K_LEFT]: self.view_x -= move_speed
-                if keys[pygame.K_RIGHT]: self.view_x += move_speed
-                if keys[pygame.K_UP]: self.view_y -= move_speed
-                if keys[pygame.K_DOWN]: self.view_y += move_speed
-                if keys[pygame.K_x]: player_rotation += vrotate
-                if keys[pygame.K_c]: player_rotation -= vrotate
-            if player_rotation > 360:
-                player_rotation -= 360
-            if player_rotation < -360:
-                player_rotation += 360
+            if self.input_player:
+                # Play back one game cycle per frame, however long the frames take.
+                sim_time = ticks - SIM_TICK_MS
+            steps = 0
+            while sim_time + SIM_TICK_MS <= ticks:
+                if steps == MAX_SIM_STEPS:
+                    # Too far behind (e.g. the window was dragged), drop the time we can't catch up with.
+                    sim_time = ticks - SIM_TICK_MS
+                    break
+                previous = self.sim_state()
+                if self.play_mode:
+                    if self.input_player:
+                        inputs = self.input_player.get(self.play_cycle)
+                    else:
+                        inputs = actions | sum(keys[getattr(pygame, name)] << bit for bit, name in enumerate(INPUT_KEYS))
+                        actions = 0
+                    self.step_inputs(inputs)
+                else:
+                    self.step(keys)
+                sim_time += SIM_TICK_MS
+                steps += 1
+            # Render between the last 2 simulation states for a smooth movement at any frame rate.
+            current = self.sim_state()
+            self.sim_alpha = 1.0 if self.input_player else (ticks - sim_time) / SIM_TICK_MS
+            if self.input_player and self.play_cycle >= self.input_player.end:
+                self.end_replay()
+            self.set_sim_state(self.interpolate_sim_state(previous, current, self.sim_alpha))
             # Alternative way to handle the zoom, useful for a more progressive one.
             #if keys[pygame.K_u] and self.base_scale > 0.05: self.base_scale /= 1.01
             #if keys[pygame.K_d] and self.base_scale < 8: self.base_scale *= 1.01
+            self.stats.stop('events')
+            self.update_animations(ticks)
             self.screen.fill((0, 0, 0))
-            vx_int, vy_int = int(self.view_x), int(self.view_y)
-            # Margin to handle parallax bringing blocks from sides
-            margin = 1
-            range_x, range_y = int(self.display_tiles_h / self.base_scale), int(self.display_tiles_v / self.base_scale)
+            lod = self.use_lod()
+            if lod:
+                self.draw_lod(range(self.min_z, self.max_z))
             for z in reversed(range(self.min_z, self.max_z)):
-                min_x, min_y = self.screen_to_world(0, 0, z)
-                max_x, max_y = self.screen_to_world(self.screen_width, self.screen_height, z)
-                min_x, min_y = int(min_x-margin), int(min_y-margin)
-                max_x, max_y = int(max_x+margin+1), int(max_y+margin+1)
-                if self.show_tiles:
-                    for step in ['sides', 'lid']:
-                        for y in range(min_y, max_y):
-                            if y < 0 or y >= 256: continue
-                            for x in range(min_x, max_x):
-                                if x < 0 or x >= 256: continue
-                                height, blocks = self.cmp.get_column(x, y)
-                                delta = 6-len(blocks)
-                                if (z - delta) >= 0 and (z-delta) < len(blocks):
-                                    block = blocks[z-delta]
-                                    z1, z2, z3, z4 = self.get_slope_heights(z, block['slope'])
-                                    c1, c2, c3, c4 = self.world_to_screen(x,y,z1), self.world_to_screen(x+1,y,z2), self.world_to_screen(x+1,y+1,z3), self.world_to_screen(x,y+1,z4)
-                                    if step == 'sides' and self.show_sides and z < 5:
-                                        b1, b2, b3, b4 = self.world_to_screen(x,y,z+1), self.world_to_screen(x+1,y,z+1), self.world_to_screen(x+1,y+1,z+1), self.world_to_screen(x,y+1,z+1)
-                                        if block['top'] > 0:
-                                            self.draw_textured_side(pygame.transform.flip(self.get_tile_surface('side', block['top'], ticks), block['flip_top_bottom'], 0), c1, c2, b2, b1)
-                                        if block['bottom'] > 0 and not block['flat']:
-                                            self.draw_textured_side(pygame.transform.flip(self.get_tile_surface('side', block['bottom'], ticks), block['flip_top_bottom'], 0), c4, c3, b3, b4)
-                                        if block['left'] > 0:
-                                            self.draw_textured_side(pygame.transform.flip(self.get_tile_surface('side', block['left'], ticks), block['flip_left_right'], 0), c1, c4, b4, b1)
-                                        if block['right'] > 0 and not block['flat']:
-                                            self.draw_textured_side(pygame.transform.flip(self.get_tile_surface('side', block['right'], ticks), block['flip_left_right'], 0), c2, c3, b3, b2)
-                                    if step == 'lid' and self.show_lids:
-                                        if block['lid'] > 0:
-                                            lid_remap = block['lid_remap']
-                                            if not self.apply_remaps:
-                                                lid_remap = 0
-                                            surf = self.get_tile_surface('lid', block['lid'], ticks, lid_remap)
-                                            if surf:
-                                                if block['lid_rotation'] != 0: surf = pygame.transform.rotate(surf, -90 * block['lid_rotation'])
-                                                w, h = int(c2[0]-c1[0])+1, int(c4[1]-c1[1])+1
-                                                if block['slope'] != 0:
-                                                    # I'm not sure why this is needed, but without the 'spill', there's a black border around some of the blocks with slopes.
-                                                    # This doesn't fully fix the issue but this is the best result I managed so far.
-                                                    spill = 2*self.base_scale
-                                                    c1 = int(c1[0]), int(c1[1])
-                                                    c2 = int(c2[0]+spill), int(c2[1])
-                                                    c3 = int(c3[0]+spill), int(c3[1]+spill)
-                                                    c4 = int(c4[0]), int(c4[1]+spill)
-                                                    self.draw_textured_side(surf, c1, c2, c3, c4)
-                                                else:
-                                                    if w > 0 and h > 0:
-                                                        self.screen.blit(pygame.transform.scale(surf, (w, h)), (int(c1[0]), int(c1[1])))
-                                                    else:
-                                                        print(f"WARNING: Unexpected width & height for lid: {w},{h}")
-                if self.show_objects:
-                    for obj in self.cmp.objects:
-                        ox, oy, oz = obj['x']/64.0, obj['y']/64.0, (obj['z']+1)/64.0
-                        if int(oz) == z:
-                            if min_x < ox < max_x and min_y < oy < max_y:
-                                sx, sy, scale = self.world_to_screen(ox, oy, oz)
-                                spr_num = -1
-                                if obj['remap'] >= 128:
-                                    info = next(car for car in self.g24.car_info if car['model'] == obj['type'])
-                                    base_name = 'car'
-                                    if info['vtype'] == 0: base_name = 'bus'
-                                    elif info['vtype'] == 3: base_name = 'bike'
-                                    elif info['vtype'] == 8: base_name = 'train'
-                                    elif info['vtype'] == 9: base_name = 'tram'
-                                    elif info['vtype'] == 13: base_name = 'boat'
-                                    elif info['vtype'] == 14: base_name = 'tank'
-                                    spr_num = self.g24.sprite_bases.get(base_name, 0) + info['spr_num']
-                                else:
-                                    o_idx = obj['type']
-                                    if o_idx < len(self.g24.object_info):
-                                        info = self.g24.object_info[o_idx]
-                                        if info['status'] == 3:  # invisible
-                                            continue
-                                        spr_num = self.g24.sprite_bases.get('object', 0) + info['spr_num']
-                                        if info['status'] == 5 or info['status'] == 9:
-                                            frames = 8
-                                            if info['status'] == 5:
-                                                frames = info['width']
-                                            speed = info['height']
-                                            frame_idx = (ticks // max(1, (speed * 1000 // 60))) % frames
-                                            spr_num += frame_idx
-                                    else:
-                                        print(f"ERROR: Object not found: {o_idx}")
-                                if spr_num >= 0:
-                                    spr_surf = self.get_sprite_surface(spr_num, remap=-1)
-                                    if spr_surf:
-                                        scaled = pygame.transform.scale(spr_surf, (max(1, int(spr_surf.get_width()*scale)), max(1, int(spr_surf.get_height()*scale))))
-                                        rotated = pygame.transform.rotate(scaled, obj['rotation'] * 90 / 256)
-                                        self.screen.blit(rotated, (int(sx - rotated.get_width()/2), int(sy - rotated.get_height()/2)))
-                if show_player > 0 and z == player_height:
-                    sx, sy, scale = self.world_to_screen(self.view_x + 10, self.view_y + 8, player_height)
+                if not lod:
+                    self.draw_layer(z, ticks)
+                if self.world.show_player > 0 and z == self.world.player_height:
+                    self.stats.start('player')
+                    sx, sy, scale = self.world_to_screen(self.view_x + 10, self.view_y + 8, self.world.player_height)
                     convertible = False
-                    if show_player == 1:
+                    if self.world.show_player == 1:
                         anim_speed = 2 # works well (at least for walking/running)
-                        anim_idx = ((ticks - anim_tick_start) // (1000 * anim_speed // 20)) % ped_grouping[player_sprite]
-                        spr_num = self.g24.sprite_bases['ped'] + ped_boundaries[player_sprite] + anim_idx
-                        if 'newcarclut_size' in self.g24.header:
-                            base_remap = self.g24.header['newcarclut_size'] // 1024 - 64  # There are 64 remaps for pedestrian and they are at the end of the newcarclut section
-                        else:
-                            base_remap = 125
-                        remap = -1
-                        if player_remap > 0:
-                            remap = base_remap+player_remap-1
-                        spr_surf = self.get_sprite_surface(spr_num, remap)
-                    elif show_player == 2:
-                        car_info = self.g24.car_info[player_sprite]
+                        anim_idx = ((ticks - anim_tick_start) // (1000 * anim_speed // 20)) % ped_grouping[self.world.player_sprite]
+                        spr_num = self.g24.sprite_bases['ped'] + ped_boundaries[self.world.player_sprite] + anim_idx
+                        spr_surf = self.get_sprite_surface(spr_num, self.pedestrian_remap(self.world.player_remap))
+                    elif self.world.show_player == 2:
+                        car_info = self.g24.car_info[self.world.player_sprite]
                         motorbike = car_info['vtype'] == 3
                         convertible = car_info['convertible'] != 0
                         spr_num = car_info['spr_num'] + self.g24.sprite_bases[self.vehicle_type_const(car_info['vtype'])]
-                        base_remap = player_sprite * 12  # There are 12 remaps per car
+                        base_remap = self.world.player_sprite * 12  # There are 12 remaps per car
                         remap = -1
-                        if player_remap > 0:
-                            remap = base_remap+player_remap-1
-                        spr_surf = self.get_sprite_surface(spr_num, remap)
+                        if self.world.player_remap > 0:
+                            remap = base_remap+self.world.player_remap-1
+                        info = self.g24.sprite_info[spr_num]
+                        deltas = tuple(i for i in range(info['dc']) if self.world.player_deltas >> i & 1)
+                        rider = None
                         if convertible or motorbike:
                             rpx, rpy = car_info['doors'][0]['rpx'], car_info['doors'][0]['rpy']
                             driving = 20
                             if motorbike:
                                 driving = 16
                             spr2_num = self.g24.sprite_bases['ped'] + ped_boundaries[driving]
-                            spr2_surf = self.get_sprite_surface(spr2_num, 0)
-                            #print(f"{"Convertible" if convertible else "Motorbike"} {player_sprite}: {rpx},{rpy}")
+                            spr2_info = self.g24.sprite_info[spr2_num]
+                            #print(f"{"Convertible" if convertible else "Motorbike"} {self.world.player_sprite}: {rpx},{rpy}")
                             if motorbike:
                                 # This is not what the game does but it works quite well for motorbikes!
                                 # Actually this looks better for the superbike than in the real game.
-                                if player_sprite == 29:
-                                    spr_surf.blit(spr2_surf, ((spr_surf.get_width() - spr2_surf.get_width())/ 2, (spr_surf.get_height() - spr2_surf.get_height())/ 2))
+                                if self.world.player_sprite == 29:
+                                    rider = (spr2_num, (info['w'] - spr2_info['w']) // 2, (info['h'] - spr2_info['h']) // 2)
                                 # For the basic motorbike, this one looks better:
-                                if player_sprite == 3:
-                                    spr_surf.blit(spr2_surf, ((spr_surf.get_width() - spr2_surf.get_width())/ 2 - 1, (spr_surf.get_height() - spr2_surf.get_height())/ 2 - 2))
+                                if self.world.player_sprite == 3:
+                                    rider = (spr2_num, (info['w'] - spr2_info['w']) // 2 - 1, (info['h'] - spr2_info['h']) // 2 - 2)
                             else:
                                 # This doesn't make sense either, but this works quite well for all the convertible cars!
-                                spr_surf.blit(spr2_surf, (spr_surf.get_width() / 2, rpy))
+                                rider = (spr2_num, info['w'] // 2, rpy)
+                        # The driver is drawn on a copy of the sprite, so that the plain sprite stays intact in the cache.
+                        spr_surf = self.get_composite_surface(spr_num, remap, deltas, rider)
                     if spr_surf:
                         scaled = pygame.transform.scale(spr_surf, (max(1, int(spr_surf.get_width()*scale)), max(1, int(spr_surf.get_height()*scale))))
-                        rotated = pygame.transform.rotate(scaled, player_rotation)
+                        rotated = pygame.transform.rotate(scaled, self.world.player_rotation)
+                        self.stats.count('blits')
                         self.screen.blit(rotated, (int(sx - rotated.get_width()/2), int(sy - rotated.get_height()/2)))
+                    self.stats.stop('player')
 
 
 
-            # Code to find where blocks with a particular property are
-            if False:
-                for y in range(0, 256):
-                    for x in range(0, 256):
-                        _, blocks = self.cmp.get_column(x, y)
-                        for block in blocks:
-                            #if block['lid_remap'] != 0:
-                            #    print(f"Remapped lid at {x},{y}")
-                            if block['traffic_lights'] != 0:
-                                print(f"Traffic lights {block['traffic_lights']} at {x},{y}")
-                break
             # Code to find where objects with a particular property are
             if False:
                 for obj in self.cmp.objects:
@@ -1217,15 +3001,16 @@ class MapRenderer:
                         y = obj['y'] // 64
                         print(f"Remapped object at {x},{y}: {obj} - {obj_info}")
                     if obj['remap'] > 128:
-                        car_info = next(car for car in self.g24.car_info if car['model'] == obj['type'])
+                        car_info = self.car_models[obj['type']]
                         x = obj['x'] // 64
                         y = obj['y'] // 64
                         print(f"Remapped car at {x},{y}: {obj} - {car_info}")
                 break
 
+            self.stats.start('hud')
             # Display selected weapon
-            if self.play_mode and player_weapon > 0:
-                weapon = self.get_sprite_surface(player_weapon + 29, 0)
+            if self.play_mode and self.world.player_weapon > 0:
+                weapon = self.get_sprite_surface(self.world.player_weapon + 29, 0)
                 scaled_weapon = pygame.transform.scale(weapon, (weapon.get_width()*self.ui_scale, weapon.get_height()*self.ui_scale))
                 self.screen.blit(scaled_weapon, (0, 0))
 
@@ -1233,21 +3018,16 @@ class MapRenderer:
             # TODO: Understand the logic the game uses to split areas in North/South East/West and Central: is it just splitting the area in 9? Is it more subtle?
             area_name = self.get_area_name(int(self.view_x + 10), int(self.view_y + 8))
             if area_name:
-                img = self.font.render(area_name, True, (255, 255, 0))
-                bg = pygame.Surface((img.get_width() + 40, img.get_height() + 40))
-                bg.fill((0, 0, 0))
-                bg.set_alpha(100)
+                img = self.render_text(area_name, (255, 255, 0))
+                bg = self.get_background(img.get_width() + 40, img.get_height() + 40, 100)
                 self.screen.blit(bg, (self.screen_width // 2 - img.get_width() // 2 - 20, self.screen_height - 50 - 20))
                 self.screen.blit(img, (self.screen_width // 2 - img.get_width() // 2, self.screen_height - 50))
 
             if show_help:
-                lines = [self.font.render(line, True, (255, 255, 255)) for line in help_text]
+                lines = [self.render_text(line) for line in help_text]
                 width = max([l.get_width() for l in lines])
                 height = 40 + sum([l.get_height() for l in lines])
-                bg = pygame.Surface((width, height))
-                bg.fill((0, 0, 0))
-                bg.set_alpha(180)
-                self.screen.blit(bg, (10, 10))
+                self.screen.blit(self.get_background(width, height, 180), (10, 10))
                 dy = 0
                 for l in lines:
                     self.screen.blit(l, (30, 30+dy))
@@ -1256,29 +3036,48 @@ class MapRenderer:
                 mode = "Play" if self.play_mode else "Display"
                 text1 = f"Mode: {mode}  X: {self.view_x:.0f} Y: {self.view_y:.0f}  FPS: {fps:.2f}  zoom: {100*self.base_scale}"
                 text2 = f"Remaps: {self.apply_remaps} - Clicked pos (tile): {self.clicked_x}, {self.clicked_y} ({self.clicked_x//64}, {self.clicked_y//64})"
+                if self.recorder and not self.recorder.paused:
+                    text2 += f" - REC {self.recorder.frame} ({self.recorder.dropped} dropped)"
                 text3 = ""
-                if show_player == 1:
-                    text3 = f"Player: remap: {player_remap} - height: {player_height} - sprite: {ped_legends[player_sprite]} - rotation: {player_rotation}"
-                if show_player == 2:
-                    text3 = f"Car: remap: {player_remap} - height: {player_height} - rotation: {player_rotation}"
-                img1 = self.font.render(text1, True, (255, 255, 255))
-                img2 = self.font.render(text2, True, (255, 255, 255))
-                img3 = self.font.render(text3, True, (255, 255, 255))
+                if self.world.show_player == 1:
+                    text3 = f"Player: remap: {self.world.player_remap} - height: {self.world.player_height} - sprite: {ped_legends[self.world.player_sprite]} - rotation: {self.world.player_rotation}"
+                if self.world.show_player == 2:
+                    text3 = f"Car: remap: {self.world.player_remap} - deltas: {self.world.player_deltas:b} - height: {self.world.player_height} - rotation: {self.world.player_rotation}"
+                img1 = self.render_text(text1)
+                img2 = self.render_text(text2)
+                img3 = self.render_text(text3)
                 width = max(img1.get_width(), img2.get_width()) + 40
                 height = img1.get_height() + img2.get_height() + 50
-                if show_player:
+                if self.world.show_player:
                     width = max(width, img3.get_width() + 40)
                     height += img3.get_height() + 10
-                bg = pygame.Surface((width, height))
-                bg.fill((0, 0, 0))
-                bg.set_alpha(180)
-                self.screen.blit(bg, (10, 10))
+                self.screen.blit(self.get_background(width, height, 180), (10, 10))
                 self.screen.blit(img1, (30, 30))
                 self.screen.blit(img2, (30, 30+img1.get_height() + 10))
-                if show_player:
+                if self.world.show_player:
                     self.screen.blit(img3, (30, 60+img1.get_height() + 20))
+            if show_minimap:
+                self.draw_minimap(self.screen_width - MINIMAP_SIZE - 10, self.screen_height - MINIMAP_SIZE - 10)
+            if show_timings:
+                self.stats.draw(self.screen, self.small_font, self.screen_width - 320, 10)
+            self.stats.stop('hud')
+            self.set_sim_state(current)
+            self.stats.start('flip')
+            if self.recorder:
+                self.recorder.capture(self.screen)
             pygame.display.flip()
+            self.stats.stop('flip')
+            if self.timing:
+                self.mark_startup('first frame')
+                self.print_startup()
+                self.timing = False
+            self.stats.end_frame()
             self.clock.tick(60)
+        self.stats.close()
+        if self.recorder:
+            self.recorder.close()
+        if self.input_recorder:
+            self.input_recorder.close()
         pygame.quit()
 
 def resolution(arg):
@@ -1310,11 +3109,26 @@ if __name__ == '__main__':
     parser.add_argument('--max_z', '-Z', type=int, default=6, help='Maximum z to show')
     parser.add_argument('--resolution', '-r', type=resolution, default='1024x768', help='Screen resolution')
     parser.add_argument('--fullscreen', '-f', action='store_true', help='Fullscreen mode')
+    parser.add_argument('--frame-log', help='Write the timings of each frame to this CSV file')
+    parser.add_argument('--render-threads', type=int, default=1, help='Number of threads rasterizing the sides of the blocks')
+    parser.add_argument('--record', help='Record the frames as PNG files in this directory, or as a raw RGB24 video if it ends with .rgb')
+    parser.add_argument('--timing', action='store_true', help='Print how long the startup took, up to the first frame')
+    parser.add_argument('--lod-threshold', type=float, default=16, help='Below this number of pixels per block, draw one color per block instead of the textures (0 to disable)')
+    parser.add_argument('--crowd', type=int, default=0, help='Number of pedestrians walking on the pavements')
+    parser.add_argument('--traffic', type=int, default=0, help='Number of cars driving on the roads')
+    parser.add_argument('--record-inputs', help='Start in play mode and record the inputs of each game cycle in this REP-like file')
+    parser.add_argument('--replay', help='Start in play mode and play back the inputs recorded in this file, one game cycle per frame')
+    parser.add_argument('--headless', action='store_true', help='With --replay, play back the inputs as fast as possible without displaying anything')
 
     args = parser.parse_args()
-
-    renderer = MapRenderer(args.cmp_file, args.g24_file, show_objects=not args.no_objects, show_tiles=not args.no_tiles, show_sides=not args.no_sides, show_lids=not args.no_lids, min_z=args.min_z, max_z=args.max_z, width=args.resolution[0], height=args.resolution[1], fullscreen=args.fullscreen)
-    renderer.run()
+    if args.headless and not args.replay:
+        parser.error('--headless requires --replay')
+
+    renderer = MapRenderer(args.cmp_file, args.g24_file, show_objects=not args.no_objects, show_tiles=not args.no_tiles, show_sides=not args.no_sides, show_lids=not args.no_lids, min_z=args.min_z, max_z=args.max_z, width=args.resolution[0], height=args.resolution[1], fullscreen=args.fullscreen, headless=args.headless, frame_log=args.frame_log, render_threads=args.render_threads, lod_threshold=args.lod_threshold, record=args.record, timing=args.timing, crowd=args.crowd, traffic=args.traffic, record_inputs=args.record_inputs, replay=args.replay)
+    if args.headless:
+        renderer.replay()
+    else:
+        renderer.run()
 
     if profile:
         pr.disable()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+import argparse
+import hashlib
+import json
+import os
+import struct
+import sys
+from multiprocessing import Pool
+
+import cv2
+import numpy as np
+
+import display_map
+
+# Size of the tiles in pixels, as expected by slippy map viewers (Leaflet, OpenLayers, ...).
+TILE_SIZE = 256
+MAP_SIZE = 256
+
+INDEX_HTML = """<!DOCTYPE html>
+<html>
+<head>
+  <meta charset="utf-8"/>
+  <title>{title}</title>
+  <link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css"/>
+  <script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
+  <style>html, body, #map {{ height: 100%; margin: 0; background: #000; }}</style>
+</head>
+<body>
+  <div id="map"></div>
+  <script>
+    var map = L.map('map', {{crs: L.CRS.Simple, minZoom: {min_zoom}, maxZoom: {max_zoom}}});
+    L.tileLayer('{{z}}/{{x}}/{{y}}.png', {{minZoom: {min_zoom}, maxZoom: {max_zoom}, noWrap: true,
+        bounds: [[-{tile_size}, 0], [0, {tile_size}]]}}).addTo(map);
+    map.setView([-{half}, {half}], {min_zoom});
+  </script>
+</body>
+</html>
+"""
+
+_renderer = None
+
+def init_worker(cmp_file, style_file):
+    global _renderer
+    _renderer = display_map.MapRenderer(cmp_file, style_file, width=TILE_SIZE, height=TILE_SIZE, headless=True)
+    # Tiles are rendered independently so they must not have any parallax,
+    # otherwise buildings wouldn't match at the tiles boundaries.
+    _renderer.scale_factor = 0
+
+def tile_path(outdir, z, x, y):
+    return os.path.join(outdir, str(z), str(x), f"{y}.png")
+
+def blocks_per_tile(z):
+    return MAP_SIZE / (1 << z)
+
+def render_leaf(job):
+    """ Renders one tile of the most detailed level. Runs in a worker process. """
+    outdir, z, x, y = job
+    n = blocks_per_tile(z)
+    # One block is 64 pixels at scale 1.0.
+    zoom = TILE_SIZE / n / 64
+    rgb = _renderer.render_view((x + 0.5) * n, (y + 0.5) * n, zoom, size=(TILE_SIZE, TILE_SIZE))
+    path = tile_path(outdir, z, x, y)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    cv2.imwrite(path, cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR))
+    return job
+
+def downsample(job):
+    """ Builds one tile from its 4 children of the next level. Runs in a worker process. """
+    outdir, z, x, y = job
+    mosaic = np.zeros((2 * TILE_SIZE, 2 * TILE_SIZE, 3), dtype=np.uint8)
+    for dy in range(2):
+        for dx in range(2):
+            child = cv2.imread(tile_path(outdir, z + 1, 2 * x + dx, 2 * y + dy))
+            if child is not None:
+                mosaic[dy * TILE_SIZE:(dy + 1) * TILE_SIZE, dx * TILE_SIZE:(dx + 1) * TILE_SIZE] = child
+    path = tile_path(outdir, z, x, y)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    cv2.imwrite(path, cv2.resize(mosaic, (TILE_SIZE, TILE_SIZE), interpolation=cv2.INTER_AREA))
+    return job
+
+def cells_content(cmp):
+    """ Returns, for each cell of the map, the bytes that influence its rendering (column, blocks and objects). """
+    cells = []
+    for y in range(MAP_SIZE):
+        for x in range(MAP_SIZE):
+            col_offset = cmp.base[y * MAP_SIZE + x]
+            if col_offset >= len(cmp.column_data):
+                cells.append(b'')
+                continue
+            height = struct.unpack_from('<H', cmp.column_data, col_offset)[0]
+            count = 6 - height
+            content = cmp.column_data[col_offset : col_offset + 2 + 2 * count]
+            for blk_idx in struct.unpack_from('<' + 'H' * count, cmp.column_data, col_offset + 2):
+                content += cmp.block_data[blk_idx * 8 : blk_idx * 8 + 8]
+            cells.append(content)
+    for obj in cmp.objects:
+        idx = (obj['y'] // 64 % MAP_SIZE) * MAP_SIZE + obj['x'] // 64 % MAP_SIZE
+        cells[idx] += repr(sorted(obj.items())).encode()
+    return cells
+
+def leaf_hashes(cmp, z, style_digest):
+    """ Hashes, for each tile of level z, everything used to render it. """
+    cells = cells_content(cmp)
+    n = int(blocks_per_tile(z))
+    # Blocks from the neighbouring tiles can overlap with this one (sides, sprites).
+    margin = 1
+    hashes = {}
+    for ty in range(1 << z):
+        for tx in range(1 << z):
+            h = hashlib.sha1(style_digest)
+            h.update(f"{z}/{TILE_SIZE}".encode())
+            for y in range(max(0, ty * n - margin), min(MAP_SIZE, (ty + 1) * n + margin)):
+                for x in range(max(0, tx * n - margin), min(MAP_SIZE, (tx + 1) * n + margin)):
+                    h.update(cells[y * MAP_SIZE + x])
+            hashes[(z, tx, ty)] = h.hexdigest()
+    return hashes
+
+def parent_hashes(children, z):
+    hashes = {}
+    for ty in range(1 << z):
+        for tx in range(1 << z):
+            h = hashlib.sha1()
+            for dy in range(2):
+                for dx in range(2):
+                    h.update(children[(z + 1, 2 * tx + dx, 2 * ty + dy)].encode())
+            hashes[(z, tx, ty)] = h.hexdigest()
+    return hashes
+
+def main():
+    parser = argparse.ArgumentParser(description='Render a whole map as a z/x/y pyramid of 256x256 tiles')
+    parser.add_argument('cmp_file', help='Input CMP file')
+    parser.add_argument('g24_file', help='Input G24 or GRY file')
+    parser.add_argument('output', help='Output directory')
+    parser.add_argument('--min-zoom', type=int, default=0, help='Least detailed zoom level (the whole map in one tile)')
+    parser.add_argument('--max-zoom', type=int, default=6, help='Most detailed zoom level (6 is 64 pixels per block)')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count(), help='Number of worker processes')
+    parser.add_argument('--force', action='store_true', help='Render all tiles, even the unchanged ones')
+    args = parser.parse_args()
+
+    for f in [args.cmp_file, args.g24_file]:
+        if not os.path.exists(f):
+            print(f"File not found: {f}")
+            sys.exit(1)
+    if not 0 <= args.min_zoom <= args.max_zoom <= 8:
+        print(f"Invalid zoom levels {args.min_zoom}-{args.max_zoom}, want 0 <= min <= max <= 8")
+        sys.exit(1)
+
+    manifest_path = os.path.join(args.output, 'tiles.json')
+    manifest = {}
+    if os.path.exists(manifest_path) and not args.force:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    with open(args.g24_file, 'rb') as f:
+        style_digest = hashlib.sha1(f.read()).digest()
+    cmp = display_map.CMPParser(args.cmp_file)
+
+    def outdated(hashes):
+        return [(args.output,) + key for key, h in hashes.items()
+                if manifest.get('/'.join(map(str, key))) != h or not os.path.exists(tile_path(args.output, *key))]
+
+    hashes = leaf_hashes(cmp, args.max_zoom, style_digest)
+    all_hashes = dict(hashes)
+    with Pool(args.jobs, initializer=init_worker, initargs=(args.cmp_file, args.g24_file)) as pool:
+        for z in range(args.max_zoom, args.min_zoom - 1, -1):
+            if z < args.max_zoom:
+                hashes = parent_hashes(hashes, z)
+                all_hashes.update(hashes)
+            todo = outdated(hashes)
+            print(f"Zoom {z}: {len(todo)} tiles to render, {len(hashes) - len(todo)} unchanged")
+            work = render_leaf if z == args.max_zoom else downsample
+            for done, _ in enumerate(pool.imap_unordered(work, todo, chunksize=4), 1):
+                if done % 256 == 0:
+                    print(f"  {done}/{len(todo)}")
+        # SDL handles SIGTERM in the workers, so let them exit on their own
+        # rather than relying on Pool.terminate().
+        pool.close()
+        pool.join()
+
+    with open(manifest_path, 'w') as f:
+        json.dump({'/'.join(map(str, key)): h for key, h in sorted(all_hashes.items())}, f, indent=0)
+    with open(os.path.join(args.output, 'index.html'), 'w') as f:
+        f.write(INDEX_HTML.format(title=os.path.basename(args.cmp_file), min_zoom=args.min_zoom,
+                                  max_zoom=args.max_zoom, tile_size=TILE_SIZE, half=TILE_SIZE // 2))
+
+if __name__ == '__main__':
+    main()
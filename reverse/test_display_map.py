@@ -0,0 +1,21 @@
+from display_map import InputPlayer, InputRecorder, INPUT_UP, INPUT_LEFT, INPUT_NEXT_WEAPON
+
+def replay(path, recorded):
+    recorder = InputRecorder(path)
+    for cycle, inputs in enumerate(recorded):
+        recorder.record(cycle, inputs)
+    recorder.close()
+    player = InputPlayer(path)
+    return [player.get(cycle) for cycle in range(player.end)]
+
+def test_replay_held_keys(tmp_path):
+    recorded = [0, INPUT_UP, INPUT_UP, INPUT_UP | INPUT_LEFT, INPUT_LEFT, 0]
+    assert replay(tmp_path / 'held.rep', recorded) == recorded
+
+def test_replay_repeated_actions(tmp_path):
+    recorded = [0, INPUT_NEXT_WEAPON, INPUT_NEXT_WEAPON, 0, 0]
+    assert replay(tmp_path / 'actions.rep', recorded) == recorded
+
+def test_replay_actions_while_holding(tmp_path):
+    recorded = [INPUT_UP, INPUT_UP | INPUT_NEXT_WEAPON, INPUT_UP | INPUT_NEXT_WEAPON, INPUT_UP, INPUT_UP, 0]
+    assert replay(tmp_path / 'mixed.rep', recorded) == recorded